@@ -0,0 +1,265 @@
+'''pastpath.cache : caches in front of external routing requests
+'''
+import asyncio
+from collections import OrderedDict
+import time
+
+from app import db
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Dict-like cache that evicts the least recently used key past maxsize
+
+    Entries older than ttl seconds, if given, are treated as missing.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        value, expires = self._data[key]
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def values(self):
+        """Values of unexpired entries, least recently used first"""
+        now = time.monotonic()
+        return [value for (value, expires) in self._data.values()
+                if expires is None or expires >= now]
+
+    def clear(self):
+        self._data.clear()
+
+
+class SingleFlight:
+    """Shares the computation of a key between concurrent callers.
+
+    A caller asking for keys already being computed waits for that result
+    instead of computing them again. Nothing is kept once a computation
+    finishes; the caches behind it take over from there.
+    """
+
+    def __init__(self):
+        # key: task computing {key: result} for a group of keys
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def run(self, keys, compute):
+        """Results for distinct keys, in order, and the number of keys joined
+
+        compute(keys) returns a list of results for keys. It is called once,
+        with the keys no other caller is computing.
+        """
+        tasks = {key: self._flights[key] for key in keys if key in self._flights}
+        joined = len(tasks)
+        own = [key for key in keys if key not in tasks]
+        if own:
+            async def fly():
+                return dict(zip(own, await compute(own)))
+            task = asyncio.create_task(fly())
+            task.add_done_callback(lambda x: self._land(own, x))
+            for key in own:
+                self._flights[key] = tasks[key] = task
+
+        results = {}
+        for flight in {id(x): x for x in tasks.values()}.values():
+            # shielded so a caller going away doesn't cancel it for the others
+            results.update(await asyncio.shield(flight))
+        return [results[key] for key in keys], joined
+
+    def _land(self, keys, task):
+        # its error was raised to the callers waiting, don't log it as unseen
+        if not task.cancelled():
+            task.exception()
+        for key in keys:
+            if self._flights.get(key) is task:
+                del self._flights[key]
+
+
+class DurationCache:
+    """Travel durations (seconds) between marker pairs for a routing profile.
+
+    Lookups go to an in-memory LRU first and then to a postgres table, which
+    is shared by all workers and survives restarts.
+    """
+
+    table = 'walking_durations_table'
+
+    def __init__(self, maxsize):
+        self.memory = LRUCache(maxsize)
+
+    async def create_table(self):
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS {} (
+                from_marker bigint NOT NULL,
+                to_marker bigint NOT NULL,
+                profile text NOT NULL,
+                duration double precision NOT NULL,
+                PRIMARY KEY (from_marker, to_marker, profile)
+            )""".format(self.table))
+
+    async def get_many(self, pairs, profile):
+        """Return {(from_marker, to_marker): duration} for cached pairs"""
+        found = {}
+        missing = []
+        for pair in pairs:
+            duration = self.memory.get(pair + (profile,))
+            if duration is None:
+                missing.append(pair)
+            else:
+                found[pair] = duration
+        if missing:
+            query = ("SELECT from_marker, to_marker, duration FROM {} "
+                     "WHERE profile = $1 AND (from_marker, to_marker) IN "
+                     "(SELECT * FROM unnest($2::bigint[], $3::bigint[]))").format(self.table)
+            rows = await db.fetch(query, profile, [x[0] for x in missing],
+                    [x[1] for x in missing])
+            for (from_marker, to_marker, duration) in rows:
+                found[(from_marker, to_marker)] = duration
+                self.memory.put((from_marker, to_marker, profile), duration)
+        return found
+
+    async def put_many(self, durations, profile):
+        """Store {(from_marker, to_marker): duration} in both tiers"""
+        if not durations:
+            return
+        for (pair, duration) in durations.items():
+            self.memory.put(pair + (profile,), duration)
+        query = ("INSERT INTO {} (from_marker, to_marker, profile, duration) "
+                 "SELECT f, t, $1, d FROM unnest($2::bigint[], $3::bigint[], $4::float8[]) AS x(f, t, d) "
+                 "ON CONFLICT (from_marker, to_marker, profile) "
+                 "DO UPDATE SET duration = EXCLUDED.duration").format(self.table)
+        pairs = list(durations)
+        await db.execute(query, profile, [x[0] for x in pairs],
+                [x[1] for x in pairs], [durations[x] for x in pairs])
+
+
+class GeometryCache:
+    """Route geometry and duration (seconds) keyed by the ordered stop ids.
+
+    Each leg between consecutive stops is cached as well, so a route made up
+    of known legs is stitched together without a directions request.
+    """
+
+    def __init__(self, maxsize, leg_maxsize, ttl=None):
+        self.routes = LRUCache(maxsize, ttl)
+        self.legs = LRUCache(leg_maxsize, ttl)
+
+    def get(self, stops):
+        """Return (coordinates, duration) of route through stops, or None"""
+        stops = tuple(stops)
+        route = self.routes.get(stops)
+        if route is not None:
+            return route
+        legs = [self.legs.get(leg) for leg in zip(stops, stops[1:])]
+        if not legs or any(leg is None for leg in legs):
+            return None
+        coords = list(legs[0][0])
+        for (leg_coords, _) in legs[1:]:
+            # each leg starts where the previous one ended
+            coords.extend(leg_coords[1:])
+        route = (coords, sum(duration for (_, duration) in legs))
+        self.routes.put(stops, route)
+        return route
+
+    def put(self, stops, coords, duration, legs=()):
+        """Store route through stops, plus its (coordinates, duration) legs"""
+        stops = tuple(stops)
+        self.routes.put(stops, (coords, duration))
+        for (leg, leg_route) in zip(zip(stops, stops[1:]), legs):
+            self.legs.put(leg, leg_route)
+
+
+def radius_bucket(radius):
+    """Key for a tour radius (miles), in hundredths of a mile"""
+    return int(round(radius * 100))
+
+
+class RouteResultCache:
+    """Route payloads (JSON) keyed by data version, start marker and radius,
+    for a routing profile.
+
+    Filled ahead of time for the preset radii by app.precompute and by live
+    requests for any other radius. Rows of other data versions are never read.
+    """
+
+    table = 'route_results_table'
+
+    def __init__(self, maxsize):
+        self.memory = LRUCache(maxsize)
+
+    async def create_table(self):
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS {} (
+                data_version text NOT NULL,
+                start_marker bigint NOT NULL,
+                radius_bucket integer NOT NULL,
+                profile text NOT NULL,
+                payload jsonb NOT NULL,
+                PRIMARY KEY (data_version, profile, start_marker, radius_bucket)
+            )""".format(self.table))
+
+    async def get_many(self, version, keys, profile):
+        """Return {(start_marker, radius_bucket): payload} for cached keys"""
+        found = {}
+        missing = []
+        for key in keys:
+            payload = self.memory.get((version, profile) + key)
+            if payload is None:
+                missing.append(key)
+            else:
+                found[key] = payload
+        if missing:
+            query = ("SELECT start_marker, radius_bucket, payload::text FROM {} "
+                     "WHERE data_version = $1 AND profile = $2 AND (start_marker, radius_bucket) IN "
+                     "(SELECT * FROM unnest($3::bigint[], $4::integer[]))").format(self.table)
+            rows = await db.fetch(query, version, profile, [x[0] for x in missing],
+                    [x[1] for x in missing])
+            for (start_marker, bucket, payload) in rows:
+                found[(start_marker, bucket)] = payload
+                self.memory.put((version, profile, start_marker, bucket), payload)
+        return found
+
+    async def put_many(self, version, payloads, profile):
+        """Store {(start_marker, radius_bucket): payload} in both tiers"""
+        if not payloads:
+            return
+        for (key, payload) in payloads.items():
+            self.memory.put((version, profile) + key, payload)
+        query = ("INSERT INTO {} (data_version, profile, start_marker, radius_bucket, payload) "
+                 "SELECT $1, $2, s, r, p::jsonb FROM unnest($3::bigint[], $4::integer[], $5::text[]) AS x(s, r, p) "
+                 "ON CONFLICT (data_version, profile, start_marker, radius_bucket) "
+                 "DO UPDATE SET payload = EXCLUDED.payload").format(self.table)
+        keys = list(payloads)
+        await db.execute(query, version, profile, [x[0] for x in keys],
+                [x[1] for x in keys], [payloads[x] for x in keys])
+
+    async def delete_other_versions(self, version, marker_ids):
+        """Delete routes from marker_ids (one city's markers) of other versions"""
+        await db.execute("DELETE FROM {} WHERE data_version <> $1 "
+                "AND start_marker = ANY($2::bigint[])".format(self.table),
+                version, [int(x) for x in marker_ids])
@@ -0,0 +1,430 @@
+'''pastpath.dataset : versioned in-memory copy of the static marker data
+
+Each city's markers are a Dataset of their own, read only from the city's
+partitions of the tables (or its snapshot) when it is first requested.
+'''
+import asyncio
+from functools import lru_cache
+import logging
+import math
+import os
+
+import asyncpg
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+
+from app import db
+from app.cache import LRUCache
+from app.markers import EARTH_RADIUS, KM_PER_DEGREE, haversine
+from app.metrics import timed
+from app.settings import get_app_settings
+from app.similarity import SimilarityIndex
+from app.snapshot import read_snapshot, snapshot_path
+from app.spatial import MarkerIndex, ViewportIndex
+
+logger = logging.getLogger(__name__)
+
+# errors of a dataset load that may pass, e.g. the database restarting, timing
+# out or not loaded by the pipeline yet. the load is retried later
+LOAD_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresError,
+               asyncpg.InterfaceError, LookupError)
+
+MARKER_COLUMNS = ['marker_id', 'title', 'lat', 'lon', 'text', 'text_clean',
+                  'img_src', 'url', 'km_label']
+
+# columns of hmdb_data_table needed to show a marker (the Marker model)
+DISPLAY_COLUMNS = ['marker_id', 'title', 'lat', 'lon', 'text_clean', 'img_src',
+                   'url']
+# half-width (km) of the first box searched for nearest markers
+NEAREST_BOX_KM = 0.5
+# MARKER_COLUMNS kept as text in a MarkerTable's string table
+STRING_COLUMNS = ['title', 'text', 'text_clean', 'img_src', 'url']
+MARKER_DTYPE = np.dtype(
+        [('marker_id', np.int64), ('lat', np.float64), ('lon', np.float64),
+         # NaN for markers without a cluster label
+         ('km_label', np.float64)] +
+        [(x + suffix, np.int64) for x in STRING_COLUMNS
+         for suffix in ('_start', '_end')])
+
+
+class MarkerRecord:
+    """Static data of one marker, in slots to keep it small"""
+
+    __slots__ = MARKER_COLUMNS
+
+    def __init__(self, marker_id, title, lat, lon, text, text_clean, img_src,
+            url, km_label):
+        self.marker_id = marker_id
+        self.title = title
+        self.lat = lat
+        self.lon = lon
+        self.text = text
+        self.text_clean = text_clean
+        self.img_src = img_src
+        self.url = url
+        self.km_label = km_label
+
+    def display(self, marker_ents=None):
+        """Fields of the Marker response model, as a dict ready to serialize"""
+        return {'lat': self.lat, 'lon': self.lon, 'title': self.title,
+                'marker_id': float(self.marker_id), 'url': self.url,
+                'text_clean': self.text_clean, 'img_src': self.img_src,
+                'marker_ents': marker_ents}
+
+
+class MarkerTable:
+    """Marker columns in one structured array, their text in one string table.
+
+    A string column of marker i is strings[start:end] with the offsets in
+    array[i]['<column>_start'], array[i]['<column>_end'], start -1 meaning
+    NULL. Flat buffers instead of Python objects per marker can be read-only
+    memory maps of a snapshot, shared by every worker. Rows are sorted by
+    marker_id.
+    """
+
+    def __init__(self, array, strings):
+        self.array = array
+        self.strings = strings
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build table from rows of MARKER_COLUMNS values"""
+        rows = sorted(rows, key=lambda x: x[0])
+        array = np.zeros(len(rows), dtype=MARKER_DTYPE)
+        parts = []
+        offset = 0
+        for (i, row) in enumerate(rows):
+            values = dict(zip(MARKER_COLUMNS, row))
+            item = array[i]
+            item['marker_id'] = values['marker_id']
+            item['lat'] = values['lat']
+            item['lon'] = values['lon']
+            item['km_label'] = (np.nan if values['km_label'] is None
+                                else values['km_label'])
+            # a marker's strings are stored together, so reading it touches
+            # one stretch of the table
+            for column in STRING_COLUMNS:
+                if values[column] is None:
+                    item[column + '_start'] = item[column + '_end'] = -1
+                    continue
+                data = values[column].encode('utf-8')
+                parts.append(data)
+                item[column + '_start'] = offset
+                offset += len(data)
+                item[column + '_end'] = offset
+        return cls(array, b''.join(parts))
+
+    def __len__(self):
+        return len(self.array)
+
+    @property
+    def marker_ids(self):
+        return self.array['marker_id']
+
+    def string(self, column, i):
+        """Value of string column of the marker in row i"""
+        item = self.array[i]
+        start = int(item[column + '_start'])
+        if start < 0:
+            return None
+        return self.strings[start:int(item[column + '_end'])].decode('utf-8')
+
+    def record(self, i):
+        """MarkerRecord of the marker in row i"""
+        item = self.array[i]
+        strings = {x: self.string(x, i) for x in STRING_COLUMNS}
+        km_label = float(item['km_label'])
+        return MarkerRecord(marker_id=int(item['marker_id']),
+                lat=float(item['lat']), lon=float(item['lon']),
+                km_label=None if math.isnan(km_label) else int(km_label),
+                **strings)
+
+
+class Dataset:
+    """Markers of a city and derived indexes for one version of the database.
+
+    Never modified after construction; a reload builds a new Dataset.
+    """
+
+    def __init__(self, city, version, table, similarity, marker_index,
+            viewport_index):
+        self.city = city
+        self.version = version
+        self.table = table
+        self.marker_ids = table.marker_ids
+        self.similarity = similarity
+        self.marker_index = marker_index
+        # positions in its queries are rows of table
+        self.viewport_index = viewport_index
+
+    def __len__(self):
+        return len(self.table)
+
+    def get_markers(self, marker_ids):
+        """MarkerRecords for marker_ids, in the order given"""
+        marker_ids = np.asarray(marker_ids, dtype=np.int64)
+        positions = np.searchsorted(self.marker_ids, marker_ids)
+        positions = np.minimum(positions, len(self.marker_ids) - 1)
+        if not np.array_equal(self.marker_ids[positions], marker_ids):
+            raise KeyError("unknown marker_id")
+        return [self.table.record(i) for i in positions.tolist()]
+
+    def warm_up(self):
+        """Run each kind of lookup once, so the first requests aren't slower"""
+        if not len(self.table):
+            return
+        marker_id = self.marker_ids[0]
+        lat, lon = self.marker_index.coords(marker_id)
+        self.marker_index.nearest(lat, lon, 7)
+        close_ids, _ = self.marker_index.within(lat, lon, 1)
+        self.similarity.top_among(marker_id, close_ids, 6)
+        self.get_markers([marker_id])
+        self.viewport_index.query(lat - 0.01, lon - 0.01, lat + 0.01,
+                lon + 0.01, 14)
+
+
+def default_city():
+    """City served when a request names none, the first of settings.cities"""
+    return get_app_settings().cities[0]
+
+
+def make_dataset(city, version, table, similarity):
+    """Dataset of a MarkerTable and SimilarityIndex, indexed and warmed up"""
+    settings = get_app_settings()
+    marker_index = MarkerIndex(table.marker_ids, table.array['lat'],
+            table.array['lon'], table.array['km_label'], settings.spatial_cell_deg)
+    viewport_index = ViewportIndex(table.array['lat'], table.array['lon'],
+            table.array['km_label'], settings.viewport_cluster_px)
+    dataset = Dataset(city, version, table, similarity, marker_index,
+            viewport_index)
+    dataset.warm_up()
+    return dataset
+
+
+def build_dataset(city, version, marker_rows, sim_rows, score_dtype=None):
+    settings = get_app_settings()
+    # keep the top k neighbors of each marker
+    marker_ids, neighbor_ids, scores = (np.array(x) for x in zip(*sim_rows))
+    similarity = SimilarityIndex.from_pairs(marker_ids, neighbor_ids, scores,
+            settings.similarity_top_k)
+    score_dtype = score_dtype or settings.similarity_score_dtype
+    if score_dtype != similarity.scores.dtype.name:
+        similarity = similarity.quantize(score_dtype)
+    return make_dataset(city, version, MarkerTable.from_rows(marker_rows),
+            similarity)
+
+
+def load_snapshot(city, path):
+    """Dataset of the snapshot at path, its arrays memory mapped read-only"""
+    version, array, strings, similarity = read_snapshot(path)
+    return make_dataset(city, version, MarkerTable(array, strings), similarity)
+
+
+async def read_version(city):
+    """Latest data version of city written by the pipeline, or None if unversioned"""
+    query = ("SELECT version FROM data_version_table WHERE cty = $1 "
+             "ORDER BY loaded_at DESC LIMIT 1")
+    try:
+        rows = await db.fetch(query, city)
+    except (asyncpg.exceptions.UndefinedTableError,
+            asyncpg.exceptions.UndefinedColumnError):
+        # versions written before there were several cities have no cty
+        return None
+    return rows[0]['version'] if rows else None
+
+
+async def read_nearest_markers(city, lat, lon, k, clusters=None):
+    """MarkerRecords (without text) of k markers of city closest to lat, lon,
+    closest first
+
+    Searches a box around the point on the indexed lat, lon columns, doubling
+    it until it holds k markers, so only a few rows are read however large
+    the table is. Used when the in-memory dataset isn't available.
+    """
+    query = ("SELECT {} FROM hmdb_data_table WHERE cty = $1 "
+             "AND lat BETWEEN $2 AND $3 AND lon BETWEEN $4 AND $5 "
+             "AND ($6::bigint[] IS NULL OR km_label = ANY($6))").format(
+                     ", ".join(DISPLAY_COLUMNS))
+
+    async def read_box(half_km):
+        # a degree of longitude is shortest at the box's edge nearest a pole,
+        # so dlon is measured there (as in GridIndex.query_radius)
+        dlat = half_km / KM_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 89.9))), 1e-6)
+        return await db.fetch(query, city, lat - dlat, lat + dlat,
+                lon - dlon, lon + dlon, clusters)
+
+    half_km = NEAREST_BOX_KM
+    rows = await read_box(half_km)
+    # stop doubling once the box spans the globe
+    while len(rows) < k and half_km < math.pi * EARTH_RADIUS:
+        half_km *= 2
+        rows = await read_box(half_km)
+    if not rows:
+        return []
+    dist = haversine(lat, lon, np.array([x['lat'] for x in rows]),
+                     np.array([x['lon'] for x in rows]))
+    kth = np.sort(dist)[min(k, len(rows)) - 1]
+    # a marker outside the box's corners could still be closer than the kth
+    if kth > half_km:
+        rows = await read_box(kth)
+        dist = haversine(lat, lon, np.array([x['lat'] for x in rows]),
+                         np.array([x['lon'] for x in rows]))
+    order = np.argsort(dist, kind='stable')[:k]
+    return [MarkerRecord(text=None, km_label=None, **dict(rows[i]))
+            for i in order.tolist()]
+
+
+async def current_version(city):
+    """Version of city to serve: the pinned snapshot_version for the default
+    city, else the database's"""
+    settings = get_app_settings()
+    if (settings.snapshot_dir and settings.snapshot_version
+            and city == default_city()):
+        return settings.snapshot_version
+    return await read_version(city)
+
+
+async def read_dataset(city, score_dtype=None):
+    """Dataset of the current database version of city, read from its
+    partitions of the tables
+
+    Similarity scores are stored as score_dtype, by default
+    similarity_score_dtype.
+    """
+    marker_query = "SELECT {} FROM hmdb_data_table WHERE cty = $1".format(
+            ", ".join(MARKER_COLUMNS))
+    sim_query = ("SELECT marker_id, neighbor_id, score "
+                 "FROM similarity_neighbors_table WHERE cty = $1")
+    timeout = get_app_settings().dataset_load_timeout
+    while True:
+        version = await read_version(city)
+        marker_rows = await db.fetch(marker_query, city, timeout=timeout)
+        sim_rows = await db.fetch(sim_query, city, timeout=timeout)
+        # the pipeline writes the version last, so if it is unchanged the
+        # tables were not replaced while being read
+        if await read_version(city) == version:
+            break
+    if not marker_rows or not sim_rows:
+        raise LookupError("no markers of city {}".format(city))
+    return await run_in_threadpool(build_dataset, city, version, marker_rows,
+            sim_rows, score_dtype)
+
+
+async def load_dataset(city):
+    """Dataset of the current version of city, from its snapshot if there is one"""
+    settings = get_app_settings()
+    if settings.snapshot_dir:
+        version = await current_version(city)
+        if version is not None:
+            path = snapshot_path(settings.snapshot_dir, city, version)
+            if os.path.isdir(path):
+                logger.info("mapping snapshot %s", path)
+                return await run_in_threadpool(load_snapshot, city, path)
+        logger.warning("no snapshot of city=%s version=%s in %s, reading the tables",
+                city, version, settings.snapshot_dir)
+    return await read_dataset(city)
+
+
+class DatasetHolder:
+    """Holds the current Dataset of a city and swaps in a new one when the
+    data changes"""
+
+    def __init__(self, city):
+        self.city = city
+        self.current = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def loading(self):
+        return self._lock.locked()
+
+    async def get(self):
+        """Current Dataset, loaded first if there is none"""
+        if self.current is None:
+            async with self._lock:
+                # loaded by another request while this one waited
+                if self.current is None:
+                    await self._load()
+        return self.current
+
+    async def reload(self, force=False):
+        """Load the dataset if its version changed (or force), return current"""
+        async with self._lock:
+            if not force and self.current is not None:
+                if await current_version(self.city) == self.current.version:
+                    return self.current
+            return await self._load()
+
+    async def _load(self):
+        with timed('dataset_load'):
+            dataset = await load_dataset(self.city)
+        # requests in flight keep the Dataset they started with
+        self.current = dataset
+        logger.info("dataset loaded city=%s version=%s markers=%d", self.city,
+                dataset.version, len(dataset))
+        return dataset
+
+
+class DatasetRegistry:
+    """DatasetHolders of the cities served, each loaded on its first request
+
+    At most max_cities are kept. Loading another drops the least recently
+    used, whose memory is freed once requests still using its Dataset finish.
+    """
+
+    def __init__(self, cities, max_cities):
+        self.cities = cities
+        self.holders = LRUCache(max_cities)
+        self._tasks = set()
+
+    def holder(self, city):
+        """DatasetHolder of city (maybe not loaded), KeyError if not served"""
+        if city not in self.cities:
+            raise KeyError("unknown city {}".format(city))
+        holder = self.holders.get(city)
+        if holder is None:
+            holder = DatasetHolder(city)
+            self.holders.put(city, holder)
+        return holder
+
+    def loaded(self, city):
+        """Current Dataset of city, or None if it isn't loaded yet"""
+        return self.holder(city).current
+
+    async def get(self, city):
+        """Current Dataset of city, loaded first if needed"""
+        return await self.holder(city).get()
+
+    def preload(self, city):
+        """Start loading city in the background unless it is loaded or loading"""
+        holder = self.holder(city)
+        if holder.current is None and not holder.loading:
+            task = asyncio.create_task(holder.get())
+            self._tasks.add(task)
+            task.add_done_callback(self._preloaded)
+
+    def _preloaded(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("dataset preload failed: %s", task.exception())
+
+    async def poll(self, interval):
+        """Check the loaded cities for a new data version every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            for holder in self.holders.values():
+                if holder.current is None:
+                    continue
+                try:
+                    await holder.reload()
+                except LOAD_ERRORS as e:
+                    logger.warning("dataset reload failed, keeping city=%s "
+                            "version=%s: %s", holder.city,
+                            holder.current.version, e)
+
+
+@lru_cache()
+def get_dataset_registry() -> DatasetRegistry:
+    settings = get_app_settings()
+    return DatasetRegistry(settings.cities, settings.max_loaded_cities)
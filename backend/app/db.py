@@ -0,0 +1,88 @@
+'''pastpath.db : pooled, non-blocking access to the postgres database
+'''
+import asyncio
+import logging
+
+import asyncpg
+
+from app.settings import get_app_settings, get_instance_settings
+
+# errors after which the connection is dropped and the query retried once on
+# a fresh connection from the pool
+RECONNECT_ERRORS = (asyncpg.exceptions.ConnectionDoesNotExistError,
+                    asyncpg.exceptions.InterfaceError,
+                    ConnectionError)
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+
+
+async def init_pool():
+    global _pool
+    settings = get_app_settings()
+    # asyncpg prepares every query and caches the prepared statements per
+    # connection, so repeated parameterized queries reuse their plans
+    _pool = await asyncpg.create_pool(
+            database=settings.db_name,
+            user=get_instance_settings().sql_user,
+            host=settings.host,
+            port=settings.port,
+            password=get_instance_settings().sql_key,
+            min_size=settings.db_pool_min_size,
+            max_size=settings.db_pool_max_size,
+            command_timeout=settings.db_command_timeout,
+            max_inactive_connection_lifetime=settings.db_pool_max_idle,
+            )
+    return _pool
+
+
+async def connect_pool():
+    """init_pool, retrying with backoff until the database accepts connections"""
+    settings = get_app_settings()
+    delay = settings.db_connect_retry_delay
+    while True:
+        try:
+            return await init_pool()
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+            logger.warning("database connection failed, retrying in %.1fs: %s",
+                    delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.db_connect_retry_max_delay)
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError("database pool not initialized")
+    return _pool
+
+
+async def fetch(query, *args, timeout=None):
+    """Run parameterized query on a pooled connection and return its rows
+
+    timeout (s) overrides db_command_timeout for long reads.
+    """
+    return await _run('fetch', query, *args, timeout=timeout)
+
+
+async def execute(query, *args):
+    """Run parameterized statement on a pooled connection"""
+    return await _run('execute', query, *args)
+
+
+async def _run(method, query, *args, timeout=None):
+    try:
+        async with get_pool().acquire() as con:
+            return await getattr(con, method)(query, *args, timeout=timeout)
+    except RECONNECT_ERRORS:
+        # the pool replaces connections that were closed under it, so one
+        # retry is enough to recover from a database restart
+        async with get_pool().acquire() as con:
+            return await getattr(con, method)(query, *args, timeout=timeout)
@@ -0,0 +1,95 @@
+'''pastpath.lifecycle : getting a worker ready to serve, without blocking startup
+
+The worker starts accepting connections straight away (so /healthz answers)
+and connects to the database, loads the dataset of the default city and warms
+up in a background task (other cities are loaded on their first request).
+/readyz reports when that is done, so a load balancer only sends traffic to
+warm workers.
+'''
+import asyncio
+import logging
+
+import asyncpg
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+
+from app import db
+from app.dataset import LOAD_ERRORS, default_city, get_dataset_registry
+from app.route import (get_duration_cache, get_route_result_cache,
+        optimal_route_from_matrix)
+from app.routing import close_ors_client
+from app.settings import get_app_settings
+
+logger = logging.getLogger(__name__)
+
+
+async def create_cache_tables():
+    # CREATE TABLE IF NOT EXISTS can still fail in workers starting together:
+    # the one that loses the race sees the table (or its type) already made
+    for cache in (get_duration_cache(), get_route_result_cache()):
+        try:
+            await cache.create_table()
+        except (asyncpg.UniqueViolationError, asyncpg.DuplicateTableError):
+            pass
+
+
+def warm_up_solver():
+    # solve a tour of typical size with the configured solver, which also
+    # imports OR-tools if that is the one used
+    rng = np.random.default_rng(0)
+    coords = rng.uniform(size=(7, 2)).tolist()
+    dist_matrix = rng.uniform(60, 600, (7, 7))
+    optimal_route_from_matrix(coords, list(range(7)), dist_matrix)
+
+
+class Lifecycle:
+    """Startup steps of a worker and whether they have finished"""
+
+    def __init__(self):
+        self.ready = False
+        self._tasks = []
+
+    async def prepare(self):
+        settings = get_app_settings()
+        await db.connect_pool()
+
+        registry = get_dataset_registry()
+        delay = settings.db_connect_retry_delay
+        tables_created = False
+        while not tables_created or registry.loaded(default_city()) is None:
+            try:
+                if not tables_created:
+                    await create_cache_tables()
+                    tables_created = True
+                # the dataset is warmed up as part of loading it
+                await registry.get(default_city())
+            except LOAD_ERRORS as e:
+                logger.warning("startup failed, retrying in %.1fs: %r",
+                        delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, settings.db_connect_retry_max_delay)
+        await run_in_threadpool(warm_up_solver)
+
+        if settings.dataset_poll_interval > 0:
+            self._tasks.append(asyncio.create_task(
+                registry.poll(settings.dataset_poll_interval)))
+        self.ready = True
+        logger.info("worker ready")
+
+    def start(self):
+        task = asyncio.create_task(self.prepare())
+        task.add_done_callback(self._log_failure)
+        self._tasks.append(task)
+
+    def _log_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("worker startup failed", exc_info=task.exception())
+
+    async def stop(self):
+        self.ready = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await close_ors_client()
+        await db.close_pool()
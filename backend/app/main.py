@@ -1,12 +1,60 @@
-from fastapi import FastAPI
+import logging
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse
 import uvicorn 
 
 from app import views
+from app.lifecycle import Lifecycle
+from app.metrics import REQUEST_SECONDS
+from app.settings import get_app_settings
 
-app = FastAPI(root_path="/api/v1")
+app = FastAPI(root_path="/api/v1", default_response_class=ORJSONResponse)
+app.state.lifecycle = Lifecycle()
 
 app.include_router(views.router)
 
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logging.getLogger('app').setLevel(get_app_settings().log_level.upper())
+
+
+@app.middleware("http")
+async def time_request(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # label by route template, so /routes/{route_id}/geometry is one series
+    route = request.scope.get('route')
+    path = route.path if route is not None else 'unmatched'
+    REQUEST_SECONDS.observe(time.perf_counter() - start,
+            method=request.method, path=path, status=response.status_code)
+    return response
+
+
+@app.on_event("startup")
+async def startup():
+    # connecting and loading data happen in the background, see /readyz
+    app.state.lifecycle.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.lifecycle.stop()
+
+
+@app.get('/healthz')
+async def healthz():
+    # the worker process is up and serving
+    return {'status': 'ok'}
+
+
+@app.get('/readyz')
+async def readyz():
+    # connected, dataset loaded and warmed up: ready for traffic
+    if not app.state.lifecycle.ready:
+        return JSONResponse({'status': 'starting'}, status_code=503)
+    return {'status': 'ready'}
+
 
 if __name__=='__main__':
     uvicorn.run(app, host='0.0.0.0', port=8000)
@@ -5,18 +5,20 @@ import sys
 
 import numpy as np
 
-def get_closest_starting_markers(lat, lon, df, n):
-    print(df.shape)
-    distances = np.array([distance((lat,lon), (lat2, lon2))
-        for (lat2, lon2) in zip(df.lat, df.lon)])
-    return df.iloc[distances.argsort()[:n]]
+EARTH_RADIUS = 6371 # km
+KM_PER_DEGREE = math.radians(EARTH_RADIUS)
+
+def get_closest_starting_markers(lat, lon, marker_index, n, clusters=None):
+    # marker_ids of n closest markers in clusters, closest first
+    marker_ids, _ = marker_index.nearest(lat, lon, n, clusters)
+    return marker_ids
 
 # Haversine formula example in Python
 # Author: Wayne Dyck
 def distance(origin, destination):
     lat1, lon1 = origin
     lat2, lon2 = destination
-    radius = 6371 # km
+    radius = EARTH_RADIUS
 
     dlat = math.radians(lat2-lat1)
     dlon = math.radians(lon2-lon1)
@@ -27,24 +29,25 @@ def distance(origin, destination):
 
     return d
 
-def get_top_locations_close(marker_id, df_similarities, n, df, radius):
-    lat, lon = df.query("marker_id=={}".format(marker_id)).loc[:, ['lat','lon']].values[0]
-    # calculate distances and filter df_similarities df
-    distances = np.array([distance((lat,lon), (lat2, lon2)) for (lat2, lon2) in zip(df.lat, df.lon)])
-    close_marker_ids = df.iloc[np.where(distances<radius)]['marker_id'].values
-    # print(type(close_marker_ids.astype(str)))
-    # close_marker_ids = np.array([114658, 113216])
-    print(df_similarities.head())
-    # can only return len(close_marker_ids) worth of points
-    if len(close_marker_ids)<n:
-        n = len(close_marker_ids)
-
-    similarities_filtered = df_similarities[close_marker_ids.astype(str)]
-    
-    interest_row = similarities_filtered.loc[marker_id]
-    # *index* of top n
-    # (last n in ascending order, then reversed)
-    top_n_idx = interest_row.values.argsort()[-n:][::-1]
-    # look up marker_id values
-    top_n_id = similarities_filtered.iloc[:,top_n_idx].columns.values.astype(int)
-    return top_n_id
+def haversine(lat, lon, lats, lons):
+    # vectorized distance() from one point to arrays of points, in km
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2-lat1)/2)**2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2-lon1)/2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+def get_top_locations_close(marker_id, sim_index, n, marker_index, radius):
+    lat, lon = marker_index.coords(marker_id)
+    # markers within radius, closest first
+    close_marker_ids, _ = marker_index.within(lat, lon, radius)
+    close_marker_ids = close_marker_ids[close_marker_ids!=marker_id]
+
+    # routing function requires having the start/end point first, followed by
+    # the most similar of the close markers
+    top_n_id = sim_index.top_among(marker_id, close_marker_ids, n-1)
+    # index only keeps top k neighbors: pad with closest remaining markers
+    if len(top_n_id) < n-1:
+        rest = close_marker_ids[~np.isin(close_marker_ids, top_n_id)]
+        top_n_id = np.concatenate([top_n_id, rest[:n-1-len(top_n_id)]])
+    return np.concatenate([[marker_id], top_n_id]).astype(int)
@@ -0,0 +1,120 @@
+'''pastpath.metrics : request stage timings and counters in Prometheus text format
+
+Metrics are kept per worker process, so each gunicorn worker reports its own.
+'''
+from contextlib import contextmanager
+import bisect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# seconds, spanning cache lookups to slow ORS requests
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+
+REGISTRY = []
+
+
+def format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for (name, value) in zip(labelnames, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Monotonic count per combination of label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[x] for x in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for (key, value) in sorted(self._values.items()):
+            yield self.name, format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, per label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values: [count per bucket (last is +Inf), sum]
+        self._values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[x] for x in self.labelnames)
+        if key not in self._values:
+            self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts, _ = self._values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key][1] += value
+
+    def samples(self):
+        for (key, (counts, total)) in sorted(self._values.items()):
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_labels(self.labelnames + ('le',), key + (bound,))
+                yield self.name + '_bucket', labels, cumulative
+            labels = format_labels(self.labelnames, key)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+def render():
+    """All registered metrics in Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append("# HELP {} {}".format(metric.name, metric.doc))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        for (name, labels, value) in metric.samples():
+            lines.append("{}{} {}".format(name, labels, value))
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram('pastpath_request_seconds',
+        'Time to handle an API request', ['method', 'path', 'status'])
+STAGE_SECONDS = Histogram('pastpath_stage_seconds',
+        'Time spent in each stage of handling a request', ['stage'])
+ORS_REQUESTS = Counter('pastpath_ors_requests_total',
+        'Requests made to OpenRouteService', ['endpoint'])
+ORS_RETRIES = Counter('pastpath_ors_retries_total',
+        'OpenRouteService requests retried, by status or error',
+        ['endpoint', 'reason'])
+CACHE_LOOKUPS = Counter('pastpath_cache_lookups_total',
+        'Keys looked up in each cache, by hit or miss', ['cache', 'result'])
+
+
+@contextmanager
+def timed(stage):
+    """Record time spent in the with block as stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        logger.debug("stage=%s seconds=%.4f", stage, elapsed)
+
+
+def count_lookups(cache, hits, misses):
+    CACHE_LOOKUPS.inc(hits, cache=cache, result='hit')
+    CACHE_LOOKUPS.inc(misses, cache=cache, result='miss')
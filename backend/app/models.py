@@ -1,14 +1,21 @@
 """Data models for backend"""
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from fastapi import Query
-from pydantic import BaseModel
+from pydantic import BaseModel, confloat
+
+# largest tour radius (mi) accepted, far more than a walk. radii are also
+# route cache keys (see radius_bucket), so they are bounded
+MAX_RADIUS = 50
 
 
 class StartChoice(BaseModel):
-    lat: float
-    lon: float
-    cluster: List[str] = Query(None)
+    lat: confloat(ge=-90, le=90)
+    lon: confloat(ge=-180, le=180)
+    # cluster labels (km_label), strings of digits are accepted too
+    cluster: List[int] = Query(None)
+    # HMDB city (cty) of the markers, by default the first of settings.cities
+    city: Optional[str]
 
 
 class Marker(BaseModel):
@@ -18,7 +25,7 @@ class Marker(BaseModel):
     marker_id: float
     url: str
     text_clean: str
-    img_src: str
+    img_src: Optional[str]
     marker_ents: Optional[List[str]]
 
 
@@ -30,12 +37,47 @@ class NearbyOptions(BaseModel):
 class Route(BaseModel):
     markers: List[Marker]
     map_center: List[float]
-    route_polylines: List[List[float]]
+    # missing when requested stops_first, see RouteGeometry
+    route_polylines: Optional[List[List[float]]]
     marker_order: List[int]
     route_str: str
-    optimal_duration: float
+    optimal_duration: Optional[float]
+    route_id: Optional[str]
 
 
 class RouteRequest(BaseModel):
-    radius: float
+    radius: confloat(gt=0, le=MAX_RADIUS)
     start_marker: int
+    # return the ordered stops without waiting for the walking path, which
+    # is then fetched from /routes/{route_id}/geometry
+    stops_first: bool = False
+    # city of start_marker, by default the first of settings.cities
+    city: Optional[str]
+
+
+class RouteGeometry(BaseModel):
+    route_id: str
+    route_polylines: List[List[float]]
+    optimal_duration: float
+
+
+class ViewportMarkers(BaseModel):
+    zoom: int
+    # [marker_id, lat, lon, km_label, title] of markers shown one by one
+    markers: List[Tuple[int, float, float, Optional[int], str]]
+    # [lat, lon, number of markers] of groups of markers shown as one
+    clusters: List[Tuple[float, float, int]]
+
+
+class SimilarMarker(BaseModel):
+    marker_id: int
+    score: float
+
+
+class SimilarMarkers(BaseModel):
+    marker_id: int
+    similar: List[SimilarMarker]
+
+
+class DatasetVersion(BaseModel):
+    version: Optional[str]
@@ -0,0 +1,64 @@
+'''pastpath.precompute : store routes from every marker of a city at the presets
+
+Run from backend/ with `python -m app.precompute --city <cty>` once the
+pipeline has loaded a new data version of the city. Routes already stored for
+the version are skipped, so an interrupted run (e.g. out of ORS quota) picks
+up where it stopped.
+'''
+import argparse
+import asyncio
+import logging
+
+from app import db
+from app.dataset import load_dataset
+from app.models import RouteRequest
+from app.route import get_duration_cache, get_route_result_cache
+from app.routing import close_ors_client
+from app.settings import get_app_settings
+from app.views import get_routes
+
+logger = logging.getLogger(__name__)
+
+
+async def precompute_routes(city, radii=None):
+    settings = get_app_settings()
+    if radii is None:
+        radii = settings.route_radius_presets
+    await db.init_pool()
+    try:
+        await get_duration_cache().create_table()
+        cache = get_route_result_cache()
+        await cache.create_table()
+        dataset = await load_dataset(city)
+        if dataset.version is None:
+            logger.warning("data of %s is unversioned, nothing to do", city)
+            return
+        await cache.delete_other_versions(dataset.version, dataset.marker_ids)
+
+        # start markers in Morton order, so the tours of a batch are close
+        # together and share most stops of their duration matrix
+        start_markers = dataset.marker_ids[dataset.viewport_index.all.positions]
+        route_requests = [RouteRequest(start_marker=x, radius=radius)
+                          for x in start_markers.tolist()
+                          for radius in radii]
+        batch_size = settings.max_batch_routes
+        for start in range(0, len(route_requests), batch_size):
+            await get_routes(dataset, route_requests[start:start+batch_size])
+            logger.info("precomputed routes=%d/%d city=%s version=%s",
+                min(start + batch_size, len(route_requests)),
+                len(route_requests), city, dataset.version)
+    finally:
+        await close_ors_client()
+        await db.close_pool()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='precompute pastpath routes')
+    parser.add_argument('--city', default=get_app_settings().cities[0],
+            help='HMDB city (cty) to precompute, default the first of cities')
+    parser.add_argument('--radius', type=float, action='append',
+            help='radius (mi) to precompute, default route_radius_presets')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+            format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    asyncio.run(precompute_routes(args.city, args.radius))
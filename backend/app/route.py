@@ -1,25 +1,137 @@
 '''pastpath.route : functions associated with creating routes
 '''
+import asyncio
+from functools import lru_cache
 from random import shuffle
 
-from openrouteservice import client, directions, distance_matrix, places
-from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+import numpy as np
 
-from app.settings import get_instance_settings
+from app.cache import DurationCache, GeometryCache, RouteResultCache
+from app.metrics import count_lookups, timed
+from app.routing import get_routing_backend
+from app.settings import get_app_settings
 
+# cost used by exact solver for pairs the routing backend could not route
+UNROUTABLE = 1e9
 
-def get_distance_matrix_response(marker_coords):
-    ors_clnt = client.Client(key=get_instance_settings().ors_key)
 
-    request = {'locations': marker_coords,
-           'profile': 'foot-walking',
-           'metrics': ['duration']}
-    
-    dist_matrix_response = ors_clnt.distance_matrix(**request)
-    return dist_matrix_response
+@lru_cache()
+def get_duration_cache() -> DurationCache:
+    return DurationCache(get_app_settings().duration_cache_size)
 
 
-def optimal_route_from_matrix(marker_coords, marker_names, dist_matrix, start=0):
+@lru_cache()
+def get_geometry_cache() -> GeometryCache:
+    settings = get_app_settings()
+    return GeometryCache(settings.route_cache_size, settings.leg_cache_size,
+            settings.route_cache_ttl)
+
+
+@lru_cache()
+def get_route_result_cache() -> RouteResultCache:
+    return RouteResultCache(get_app_settings().route_result_cache_size)
+
+
+async def get_distance_matrix_response(marker_coords, sources=None,
+        destinations=None):
+    return await get_routing_backend().distance_matrix(marker_coords, sources,
+            destinations)
+
+
+async def get_duration_matrix(marker_ids, marker_coords):
+    """Walking durations (s) between all markers, as nested lists
+
+    Pairs already in the duration cache are not sent to ORS; the rows and
+    columns with a missing pair are requested and the result cached.
+    """
+    backend = get_routing_backend()
+    if not backend.remote:
+        with timed('ors_matrix'):
+            return (await get_distance_matrix_response(marker_coords))['durations']
+
+    marker_ids = [int(x) for x in marker_ids]
+    pairs = [(a, b) for a in marker_ids for b in marker_ids if a != b]
+    cache = get_duration_cache()
+    with timed('duration_cache_lookup'):
+        durations = await cache.get_many(pairs, backend.profile)
+    count_lookups('duration', len(durations), len(pairs) - len(durations))
+
+    missing = [(i, j) for (i, a) in enumerate(marker_ids)
+               for (j, b) in enumerate(marker_ids)
+               if a != b and (a, b) not in durations]
+    if missing:
+        sources = sorted({i for (i, _) in missing})
+        destinations = sorted({j for (_, j) in missing})
+        # ORS caps the number of elements per matrix request
+        chunk = max(1, get_app_settings().ors_matrix_max_elements // len(destinations))
+        chunks = [sources[start:start+chunk]
+                  for start in range(0, len(sources), chunk)]
+        with timed('ors_matrix'):
+            responses = await asyncio.gather(*(get_distance_matrix_response(
+                marker_coords, x, destinations) for x in chunks))
+        new_durations = {}
+        for (response, chunk_sources) in zip(responses, chunks):
+            for (row, i) in zip(response['durations'], chunk_sources):
+                for (duration, j) in zip(row, destinations):
+                    # ORS returns null for pairs it could not route
+                    if i != j and duration is not None:
+                        new_durations[(marker_ids[i], marker_ids[j])] = duration
+        await cache.put_many(new_durations, backend.profile)
+        durations.update(new_durations)
+
+    return [[0 if a == b else durations.get((a, b)) for b in marker_ids]
+            for a in marker_ids]
+
+
+def solve_tsp_exact(dist_matrix, start=0):
+    """Shortest tour from start through every node and back, by Held-Karp
+
+    Returns node order beginning with start (which is not repeated at the
+    end). Each subset size is solved with one vectorized step, so this is
+    much faster than setting up the OR-tools model for a handful of nodes.
+    """
+    d = np.array(dist_matrix, dtype=np.float64)
+    d[np.isnan(d)] = UNROUTABLE
+    others = np.array([i for i in range(len(d)) if i != start], dtype=np.int64)
+    m = len(others)
+    if m == 0:
+        return [start]
+
+    # dp[mask, j]: cost of leaving start, visiting the others in bitmask mask
+    # and ending at others[j]. parent[mask, j] is the node visited before j.
+    d_others = d[np.ix_(others, others)]
+    bits = 1 << np.arange(m)
+    n_masks = 1 << m
+    dp = np.full((n_masks, m), np.inf)
+    parent = np.full((n_masks, m), -1, dtype=np.int64)
+    dp[bits, np.arange(m)] = d[start, others]
+
+    masks = np.arange(n_masks)
+    popcount = ((masks[:, None] & bits) != 0).sum(axis=1)
+    for size in range(2, m + 1):
+        size_masks = masks[popcount == size]
+        in_mask = (size_masks[:, None] & bits) != 0
+        # cand[mask, j, k] = dp[mask without j, k] + d[k, j]; when j is not
+        # in mask the "previous" mask is larger and still inf
+        prev = size_masks[:, None] ^ bits
+        cand = dp[prev] + d_others.T
+        best = cand.argmin(axis=2)
+        cost = np.take_along_axis(cand, best[..., None], axis=2)[..., 0]
+        dp[size_masks] = np.where(in_mask, cost, np.inf)
+        parent[size_masks] = np.where(in_mask, best, -1)
+
+    # close the loop back to start, then walk parents back from the last node
+    mask = n_masks - 1
+    j = int(np.argmin(dp[mask] + d[others, start]))
+    order = []
+    while j >= 0:
+        order.append(int(others[j]))
+        j, mask = int(parent[mask, j]), mask ^ int(bits[j])
+    return [start] + order[::-1]
+
+
+def optimal_route_from_matrix(marker_coords, marker_names, dist_matrix, start=0,
+        exact_max_size=None):
     tsp_size = len(marker_names)
     num_routes = 1
 
@@ -27,7 +139,19 @@ def optimal_route_from_matrix(marker_coords, marker_names, dist_matrix, start=0)
     marker_order = []
     route_str = ''
 
-    if tsp_size > 0:
+    if exact_max_size is None:
+        exact_max_size = get_app_settings().exact_tsp_max_size
+
+    if 0 < tsp_size <= exact_max_size:
+        # small enough to solve exactly, faster than building OR-tools model
+        marker_order = solve_tsp_exact(dist_matrix, start)
+        optimal_coords = [marker_coords[i] for i in marker_order + [start]]
+        route_str = ' -> '.join(str(marker_names[i])
+                for i in marker_order + [start])
+    elif tsp_size > 0:
+        # imported here as it is slow to load and most tours are solved exactly
+        from ortools.constraint_solver import pywrapcp
+
         # set up the routing model for TSP, see
         # https://developers.google.com/optimization/routing/tsp#python_3
         manager = pywrapcp.RoutingIndexManager(tsp_size, num_routes, start)
@@ -73,21 +197,60 @@ def optimal_route_from_matrix(marker_coords, marker_names, dist_matrix, start=0)
     return optimal_coords, marker_order, route_str
 
 
-def directions_route_duration(route_coords):
-    ors_clnt = client.Client(key=get_instance_settings().ors_key)
-    request = {'coordinates': route_coords,
-               'profile': 'foot-walking',
-               'geometry': 'true',
-               'format_out': 'geojson',
-              }
-
-    route = ors_clnt.directions(**request)
+async def directions_route_duration(route_coords):
+    route = await get_routing_backend().directions(route_coords)
     # duration in minutes
     duration = route['features'][0]['properties']['summary']['duration'] / 60
 
     return route, duration
 
 
+def split_directions_response(route):
+    """Return (coordinates, duration, legs) from geojson directions response
+
+    legs holds a (coordinates, duration) pair per pair of consecutive stops,
+    or is empty if the response has no per-segment information.
+    """
+    feature = route['features'][0]
+    coords = feature['geometry']['coordinates']
+    properties = feature['properties']
+    duration = properties['summary']['duration']
+
+    # way_points are indices into coords where each stop is reached
+    way_points = properties.get('way_points', [])
+    segments = properties.get('segments', [])
+    legs = []
+    if len(segments) == len(way_points) - 1:
+        legs = [(coords[start:end+1], segment['duration'])
+                for (start, end, segment)
+                in zip(way_points, way_points[1:], segments)]
+    return coords, duration, legs
+
+
+async def get_route_geometry(stop_ids, route_coords):
+    """Return ([lon, lat] coordinates, duration in minutes) of route through stops
+
+    Routes are cached by the ordered stop_ids, and a route whose legs are all
+    cached is built without calling ORS.
+    """
+    if not get_routing_backend().remote:
+        with timed('ors_directions'):
+            route, duration = await directions_route_duration(route_coords)
+        return route['features'][0]['geometry']['coordinates'], duration
+
+    cache = get_geometry_cache()
+    cached = cache.get(stop_ids)
+    count_lookups('geometry', int(cached is not None), int(cached is None))
+    if cached is None:
+        with timed('ors_directions'):
+            route, _ = await directions_route_duration(route_coords)
+        coords, duration, legs = split_directions_response(route)
+        cache.put(stop_ids, coords, duration, legs)
+    else:
+        coords, duration = cached
+    return coords, duration / 60
+
+
 def print_solution(manager, routing, solution):
     """Prints solution on console."""
     print('Objective: {} minutes'.format(solution.ObjectiveValue()/60))
@@ -106,7 +269,7 @@ def print_solution(manager, routing, solution):
     plan_output += 'Route distance: {}miles\n'.format(route_distance)
 
 
-def compare_random_optimized(optimal_coords):
+async def compare_random_optimized(optimal_coords):
     # NB: assumes not returning to starting point in either case
     # See what a random tour would have been
     tour_start = optimal_coords[0]
@@ -118,9 +281,10 @@ def compare_random_optimized(optimal_coords):
                'geometry': 'true',
                'format_out': 'geojson',
               }
-    random_route, random_duration = directions_route_duration(marker_coords_shuffle_loop)
+    random_route, random_duration = await directions_route_duration(
+            marker_coords_shuffle_loop)
 
-    optimal_route, optimal_duration = directions_route_duration(optimal_coords)
+    optimal_route, optimal_duration = await directions_route_duration(optimal_coords)
 
     return {'random_route': random_route,
             'random_duration': random_duration,
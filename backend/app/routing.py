@@ -0,0 +1,182 @@
+'''pastpath.routing : backends that provide walking durations and geometry
+
+Backends answer in the shape of OpenRouteService responses, so route.py and
+the caches do not depend on which one is configured.
+'''
+import asyncio
+from functools import lru_cache
+import logging
+import random
+
+import numpy as np
+import orjson
+
+from app.markers import haversine
+from app.metrics import ORS_REQUESTS, ORS_RETRIES
+from app.settings import get_app_settings, get_instance_settings
+
+logger = logging.getLogger(__name__)
+
+PROFILE = 'foot-walking'
+# statuses of responses worth retrying: rate limited, or a server error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_ors_client = None
+
+
+class OrsClient:
+    """Long-lived async client of the OpenRouteService API, one per worker.
+
+    Connections are kept alive and reused, so TLS setup is paid once per
+    connection instead of once per request, and requests wait on the event
+    loop instead of blocking a thread. At most max_concurrency requests are
+    in flight; rate limited (429) and failed (5xx, connection error)
+    requests are retried up to max_retries times after a random delay of up
+    to retry_delay * 2**attempt, at most retry_max_delay.
+    """
+
+    def __init__(self, base_url, key, max_concurrency, timeout, connect_timeout,
+            max_retries, retry_delay, retry_max_delay):
+        # imported here so workers using the local backend never load it
+        import httpx
+        self._httpx = httpx
+        self._client = httpx.AsyncClient(base_url=base_url,
+                headers={'Authorization': key},
+                timeout=httpx.Timeout(timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=max_concurrency,
+                                    max_keepalive_connections=max_concurrency))
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+
+    async def post(self, endpoint, path, body):
+        """Parsed JSON response to body posted to path"""
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                ORS_REQUESTS.inc(endpoint=endpoint)
+                try:
+                    response = await self._client.post(path, json=body)
+                    error = None
+                except self._httpx.TransportError as e:
+                    response, error = None, e
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                response.raise_for_status()
+                return orjson.loads(response.content)
+            if attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                response.raise_for_status()
+
+            delay = random.uniform(0, min(self.retry_delay * 2 ** attempt,
+                                          self.retry_max_delay))
+            reason = type(error).__name__ if error else str(response.status_code)
+            if response is not None and 'retry-after' in response.headers:
+                try:
+                    delay = min(max(delay, float(response.headers['retry-after'])),
+                                self.retry_max_delay)
+                except ValueError:
+                    pass
+            ORS_RETRIES.inc(endpoint=endpoint, reason=reason)
+            logger.warning("ors %s failed (%s), retry %d in %.2fs", endpoint,
+                    reason, attempt + 1, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+def get_ors_client():
+    global _ors_client
+    if _ors_client is None:
+        settings = get_app_settings()
+        _ors_client = OrsClient(settings.ors_base_url,
+                get_instance_settings().ors_key, settings.ors_max_concurrency,
+                settings.ors_timeout, settings.ors_connect_timeout,
+                settings.ors_max_retries, settings.ors_retry_delay,
+                settings.ors_retry_max_delay)
+    return _ors_client
+
+
+async def close_ors_client():
+    global _ors_client
+    if _ors_client is not None:
+        await _ors_client.aclose()
+        _ors_client = None
+
+
+class OrsBackend:
+    """Durations and route geometry from the OpenRouteService API"""
+
+    # responses cost time and quota, so they are worth caching
+    remote = True
+    profile = PROFILE
+
+    async def distance_matrix(self, coords, sources=None, destinations=None):
+        request = {'locations': coords, 'metrics': ['duration']}
+        # only request the rows/columns not already known
+        if sources is not None:
+            request['sources'] = sources
+        if destinations is not None:
+            request['destinations'] = destinations
+        return await get_ors_client().post('matrix',
+                '/v2/matrix/{}/json'.format(self.profile), request)
+
+    async def directions(self, coords):
+        request = {'coordinates': coords, 'geometry': True}
+        return await get_ors_client().post('directions',
+                '/v2/directions/{}/geojson'.format(self.profile), request)
+
+
+class LocalBackend:
+    """Estimates from straight-line distance between stops, without any requests
+
+    Walking distance is the haversine distance scaled by detour_factor, which
+    accounts for the street grid, and is covered at speed (m/s). Routes are
+    straight lines between stops.
+    """
+
+    remote = False
+    profile = PROFILE + '-local'
+
+    def __init__(self, speed, detour_factor):
+        self.speed = speed
+        self.detour_factor = detour_factor
+
+    def durations(self, coords, sources=None, destinations=None):
+        """Array of durations (s) from sources to destinations"""
+        coords = np.asarray(coords, dtype=np.float64)
+        origins = coords if sources is None else coords[sources]
+        targets = coords if destinations is None else coords[destinations]
+        # coords are (lon, lat); broadcast origins down rows, targets across
+        km = haversine(origins[:, 1, None], origins[:, 0, None],
+                       targets[:, 1], targets[:, 0])
+        return km * 1000 * self.detour_factor / self.speed
+
+    async def distance_matrix(self, coords, sources=None, destinations=None):
+        return {'durations': self.durations(coords, sources, destinations).tolist()}
+
+    async def directions(self, coords):
+        coords = [list(x) for x in coords]
+        n = len(coords)
+        leg_durations = np.diag(self.durations(coords), 1).tolist()
+        return {'features': [{
+            'geometry': {'type': 'LineString', 'coordinates': coords},
+            'properties': {
+                'summary': {'duration': sum(leg_durations)},
+                'way_points': list(range(n)),
+                'segments': [{'duration': x} for x in leg_durations],
+                },
+            }]}
+
+
+@lru_cache()
+def get_routing_backend():
+    settings = get_app_settings()
+    if settings.routing_backend == 'ors':
+        return OrsBackend()
+    if settings.routing_backend == 'local':
+        return LocalBackend(settings.walking_speed, settings.detour_factor)
+    raise ValueError("bad value for routing_backend, must be ors or local")
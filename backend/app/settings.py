@@ -1,4 +1,5 @@
 from functools import lru_cache
+from typing import List
 
 from pydantic import BaseSettings, Field
 
@@ -10,13 +11,95 @@ class AppSettings(BaseSettings):
     host: str = Field(..., env="PASTPATH_DB_HOST")
     db_name: str = "postgres"
     port: int = Field(..., env="PASTPATH_DB_PORT")
+    # connection pool bounds and timeouts (seconds)
+    db_pool_min_size: int = 1
+    db_pool_max_size: int = 10
+    db_command_timeout: float = 10
+    db_pool_max_idle: float = 300
+    # delay (s) between attempts to connect at startup, doubling up to max
+    db_connect_retry_delay: float = 0.5
+    db_connect_retry_max_delay: float = 30
+    # timeout (s) of the queries reading a whole city's markers and
+    # similarity neighbors into a worker, much longer than other queries
+    dataset_load_timeout: float = 300
+    # level of app log messages (per-stage timings are logged at DEBUG)
+    log_level: str = "INFO"
+    # HMDB cities (cty) served, the first one by default and loaded at
+    # startup. the others are loaded on their first request, keeping at most
+    # max_loaded_cities in memory (the least recently used is unloaded)
+    cities: List[str] = ["washington_dc"]
+    max_loaded_cities: int = 4
+    # seconds between checks for a new data version (0 disables polling)
+    dataset_poll_interval: float = 60
+    # token required in X-Admin-Token header by admin endpoints (unset
+    # disables them)
+    admin_token: str = ""
+    # directory of dataset snapshots written by app.snapshot (unset reads the
+    # tables into each worker). workers memory map the snapshot of a city's
+    # current version in the database (for the default city, snapshot_version
+    # if set), and fall back to the tables if there is none
+    snapshot_dir: str = ""
+    snapshot_version: str = ""
+    # number of most similar neighbors kept in memory per marker
+    similarity_top_k: int = 200
+    # dtype of their scores: float32, float16 or uint8 (scaled per marker),
+    # 2 or 4 times smaller. check the effect with `app.snapshot --validate`
+    similarity_score_dtype: str = "float32"
+    # decimals choose_start rounds locations to (3 is about 100 m), so
+    # concurrent requests from about the same place share one lookup
+    start_coord_decimals: int = 3
+    # size of spatial index grid cells, in degrees
+    spatial_cell_deg: float = 0.01
+    # GET /markers: map pixels per side of the grid cells markers are
+    # clustered by, the most markers returned one by one before clustering
+    # them, and the most cells a viewport is split into
+    viewport_cluster_px: int = 64
+    viewport_max_markers: int = 500
+    viewport_max_cells: int = 4096
+    # marker pairs kept in the in-memory tier of the walking duration cache
+    duration_cache_size: int = 100000
+    # walking routes (by ordered stops) and legs kept for route_cache_ttl (s)
+    route_cache_size: int = 10000
+    leg_cache_size: int = 100000
+    route_cache_ttl: float = 24 * 3600
+    # finished routes kept in memory in front of route_results_table
+    route_result_cache_size: int = 10000
+    # radii (mi) offered by the UI, whose routes are precomputed for every
+    # marker by app.precompute
+    route_radius_presets: List[float] = [0.5, 1, 2]
+    # "ors" for OpenRouteService, or "local" to estimate walking durations and
+    # paths from straight-line distance without external requests
+    routing_backend: str = "ors"
+    # OpenRouteService API, replaced by bench.fake_ors when load testing
+    ors_base_url: str = "https://api.openrouteservice.org"
+    # most ORS requests in flight per worker (and connections kept open),
+    # request and connect timeouts (s), and retries of rate limited or failed
+    # requests after a random delay up to ors_retry_delay * 2**attempt (s),
+    # at most ors_retry_max_delay
+    ors_max_concurrency: int = 8
+    ors_timeout: float = 30
+    ors_connect_timeout: float = 5
+    ors_max_retries: int = 3
+    ors_retry_delay: float = 0.5
+    ors_retry_max_delay: float = 10
+    # local backend: walking speed (m/s) and ratio of walked to straight-line
+    # distance, typical of a downtown street grid
+    walking_speed: float = 1.3
+    detour_factor: float = 1.3
+    # most sources x destinations ORS allows in one matrix request
+    ors_matrix_max_elements: int = 3500
+    # most routes accepted by one /routes/batch request
+    max_batch_routes: int = 50
+    # tours with up to this many stops are solved exactly instead of OR-tools
+    exact_tsp_max_size: int = 10
 
 
 # TODO refactor into single AppSettings
 class InstanceSettings(BaseSettings):
     sql_user: str
     sql_key: str
-    ors_key: str
+    # only needed with routing_backend "ors"
+    ors_key: str = ""
 
 
 @lru_cache()
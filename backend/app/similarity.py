@@ -0,0 +1,184 @@
+'''pastpath.similarity : in-memory top-k similarity index
+'''
+import numpy as np
+
+# dtypes scores can be stored as. uint8 scores are scaled per row
+SCORE_DTYPES = ('float32', 'float16', 'uint8')
+
+
+class SimilarityIndex:
+    """Top-k most similar neighbors of each marker, stored in CSR-style arrays.
+
+    The neighbors of marker_ids[i] are neighbor_ids[indptr[i]:indptr[i+1]],
+    sorted by descending score. marker_ids is sorted so a row is found with a
+    binary search instead of a dict lookup per request.
+
+    Scores can be stored quantized (see quantize); the score of a neighbor in
+    row i is scores * row_scales[i].
+    """
+
+    def __init__(self, marker_ids, indptr, neighbor_ids, scores,
+            row_scales=None):
+        self.marker_ids = np.asarray(marker_ids, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.neighbor_ids = np.asarray(neighbor_ids, dtype=np.int64)
+        scores = np.asarray(scores)
+        if scores.dtype.name not in SCORE_DTYPES:
+            scores = scores.astype(np.float32)
+        self.scores = scores
+        if row_scales is None:
+            row_scales = np.ones(len(self.marker_ids), dtype=np.float32)
+        self.row_scales = np.asarray(row_scales, dtype=np.float32)
+
+    @classmethod
+    def from_matrix(cls, marker_ids, similarities, k):
+        """Build index from square matrix whose rows and columns are marker_ids"""
+        marker_ids = np.asarray(marker_ids, dtype=np.int64)
+        similarities = np.asarray(similarities, dtype=np.float32)
+        k = min(k, len(marker_ids))
+
+        # top k columns per row (unordered), then sort each row by score
+        top_idx = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(similarities, top_idx, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top_idx = np.take_along_axis(top_idx, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        row_order = np.argsort(marker_ids)
+        indptr = np.arange(len(marker_ids) + 1) * k
+        return cls(marker_ids[row_order], indptr,
+                   marker_ids[top_idx[row_order]].ravel(),
+                   top_scores[row_order].ravel())
+
+    @classmethod
+    def from_pairs(cls, marker_ids, neighbor_ids, scores, k=None):
+        """Build index from long-format (marker_id, neighbor_id, score) pairs"""
+        marker_ids = np.asarray(marker_ids, dtype=np.int64)
+        neighbor_ids = np.asarray(neighbor_ids, dtype=np.int64)
+        scores = np.asarray(scores, dtype=np.float32)
+
+        # a pair listed more than once keeps its best score
+        order = np.lexsort((-scores, neighbor_ids, marker_ids))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = ((np.diff(marker_ids[order]) != 0)
+                     | (np.diff(neighbor_ids[order]) != 0))
+        order = order[first]
+        marker_ids = marker_ids[order]
+        neighbor_ids = neighbor_ids[order]
+        scores = scores[order]
+
+        order = np.lexsort((-scores, marker_ids))
+        marker_ids = marker_ids[order]
+        neighbor_ids = neighbor_ids[order]
+        scores = scores[order]
+
+        rows, starts, counts = np.unique(marker_ids, return_index=True,
+                                         return_counts=True)
+        if k is not None:
+            # rank of each pair within its marker's (sorted) row
+            rank = np.arange(len(marker_ids)) - np.repeat(starts, counts)
+            keep = rank < k
+            neighbor_ids, scores = neighbor_ids[keep], scores[keep]
+            counts = np.minimum(counts, k)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        return cls(rows, indptr, neighbor_ids, scores)
+
+    def quantize(self, dtype):
+        """Copy of the index with scores stored as dtype, one of SCORE_DTYPES
+
+        uint8 scores are scaled so each row's best score is 255, and assume
+        scores are non-negative (cosine similarities of tf-idf vectors).
+        Neighbors keep their full precision order.
+        """
+        if dtype not in SCORE_DTYPES:
+            raise ValueError("unknown score dtype {}".format(dtype))
+        scores = self.all_scores()
+        row_scales = None
+        if dtype == 'uint8':
+            counts = np.diff(self.indptr)
+            row_max = np.zeros(len(self.marker_ids), dtype=np.float32)
+            if len(scores):
+                row_max[counts > 0] = np.maximum.reduceat(
+                        scores, self.indptr[:-1][counts > 0])
+            row_scales = np.where(row_max > 0, row_max / 255, 1).astype(np.float32)
+            scores = np.rint(scores / np.repeat(row_scales, counts)).clip(0, 255)
+        return SimilarityIndex(self.marker_ids, self.indptr, self.neighbor_ids,
+                scores.astype(dtype), row_scales)
+
+    def all_scores(self):
+        """Scores of every stored neighbor as float32, in storage order"""
+        return (self.scores.astype(np.float32) *
+                np.repeat(self.row_scales, np.diff(self.indptr)))
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in (self.marker_ids, self.indptr,
+                   self.neighbor_ids, self.scores, self.row_scales))
+
+    def __len__(self):
+        return len(self.marker_ids)
+
+    def __contains__(self, marker_id):
+        return self._row(marker_id) is not None
+
+    def _row(self, marker_id):
+        i = np.searchsorted(self.marker_ids, marker_id)
+        if i < len(self.marker_ids) and self.marker_ids[i] == marker_id:
+            return i
+        return None
+
+    def neighbors(self, marker_id, k=None, include_self=True):
+        """Return (neighbor_ids, scores) of marker_id in descending score order"""
+        i = self._row(marker_id)
+        if i is None:
+            raise KeyError(marker_id)
+        ids = self.neighbor_ids[self.indptr[i]:self.indptr[i + 1]]
+        scores = (self.scores[self.indptr[i]:self.indptr[i + 1]].astype(np.float32)
+                  * self.row_scales[i])
+        if not include_self:
+            keep = ids != marker_id
+            ids, scores = ids[keep], scores[keep]
+        if k is not None:
+            ids, scores = ids[:k], scores[:k]
+        return ids, scores
+
+    def top_among(self, marker_id, candidate_ids, n):
+        """Return up to n most similar neighbors of marker_id in candidate_ids
+
+        Only the stored top-k are considered, so fewer than n ids can come back
+        even if candidate_ids is larger.
+        """
+        ids, _ = self.neighbors(marker_id, include_self=False)
+        return ids[np.isin(ids, candidate_ids)][:n]
+
+
+def overlap_report(full, quantized, ks=(6, 10, 50)):
+    """Compare a quantized SimilarityIndex with the full precision one
+
+    Rows of quantized keep the full precision order, so the tours it picks
+    are unchanged; the overlap says how much of that order the quantized
+    scores carry on their own, re-ranking each row by them (ties by
+    neighbor_id). Returns {k: (mean, min) fraction of a row's top k found in
+    both}, and the max and mean absolute score error.
+    """
+    counts = np.diff(full.indptr)
+    rows = np.repeat(np.arange(len(full)), counts)
+    full_scores = full.all_scores()
+    quantized_scores = quantized.all_scores()
+
+    def ranks(scores):
+        order = np.lexsort((full.neighbor_ids, -scores, rows))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - full.indptr[rows[order]]
+        return rank
+
+    full_rank = ranks(full_scores)
+    quantized_rank = ranks(quantized_scores)
+    overlap = {}
+    for k in ks:
+        both = (full_rank < k) & (quantized_rank < k)
+        found = np.bincount(rows[both], minlength=len(full))[counts > 0]
+        fraction = found / np.minimum(counts[counts > 0], k)
+        overlap[k] = (fraction.mean(), fraction.min()) if len(fraction) else (1, 1)
+    error = np.abs(quantized_scores - full_scores)
+    return overlap, error.max(initial=0), error.mean() if len(error) else 0
@@ -0,0 +1,167 @@
+'''pastpath.snapshot : read-only dataset bundles memory mapped by the workers
+
+The pipeline exports the dataset of each city and data version to a directory
+
+    <snapshot_dir>/<city>/<version>/
+        manifest.json       version, city, number of markers, format
+        markers.npy         MarkerTable array: ids, coordinates, cluster
+                            labels and string offsets
+        strings.bin         MarkerTable string table (utf-8)
+        similarity_*.npy    SimilarityIndex CSR arrays, scores as stored
+                            (maybe quantized, see similarity_score_dtype)
+
+Workers memory map it instead of reading the tables into their own memory, so
+the data is read into the page cache once and the pages are shared by every
+worker process on the host. Run from backend/ after loading a new version:
+
+    python -m app.snapshot --out ../data/snapshots --city washington_dc
+
+With --validate it instead reports how close similarity scores quantized to
+--score-dtype are to full precision, and how much memory they save.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from app.settings import get_app_settings
+from app.similarity import SCORE_DTYPES, SimilarityIndex, overlap_report
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 1
+SIMILARITY_ARRAYS = ['marker_ids', 'indptr', 'neighbor_ids', 'scores',
+                     'row_scales']
+
+
+def snapshot_path(snapshot_dir, city, version):
+    return os.path.join(snapshot_dir, city, version)
+
+
+def map_file(path):
+    """Read-only memory map of the file at path"""
+    with open(path, 'rb') as f:
+        # an empty file can't be mapped
+        if not os.fstat(f.fileno()).st_size:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_snapshot(dataset, snapshot_dir):
+    """Write dataset to snapshot_dir/<city>/<version>, return that path
+
+    The bundle is written next to it and renamed into place, so workers never
+    see a partial one. Workers still mapping a replaced bundle keep reading
+    its (unlinked) files.
+    """
+    path = snapshot_path(snapshot_dir, dataset.city, dataset.version)
+    city_dir = os.path.dirname(path)
+    os.makedirs(city_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.' + dataset.version, dir=city_dir)
+    try:
+        np.save(os.path.join(tmp_path, 'markers.npy'), dataset.table.array)
+        with open(os.path.join(tmp_path, 'strings.bin'), 'wb') as f:
+            f.write(dataset.table.strings)
+        for name in SIMILARITY_ARRAYS:
+            np.save(os.path.join(tmp_path, 'similarity_{}.npy'.format(name)),
+                    getattr(dataset.similarity, name))
+        manifest = {'version': dataset.version, 'city': dataset.city,
+                    'markers': len(dataset), 'format': FORMAT,
+                    'score_dtype': dataset.similarity.scores.dtype.name}
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.chmod(tmp_path, 0o755)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return path
+
+
+def read_snapshot(path):
+    """Return (version, marker array, string table, SimilarityIndex) at path
+
+    The arrays and string table are read-only memory maps of the files.
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['format'] != FORMAT:
+        raise ValueError("snapshot {} has format {}, expected {}".format(
+            path, manifest['format'], FORMAT))
+    array = np.load(os.path.join(path, 'markers.npy'), mmap_mode='r')
+    strings = map_file(os.path.join(path, 'strings.bin'))
+    arrays = {}
+    for name in SIMILARITY_ARRAYS:
+        array_path = os.path.join(path, 'similarity_{}.npy'.format(name))
+        # bundles of unquantized scores from before row_scales
+        if name == 'row_scales' and not os.path.exists(array_path):
+            continue
+        arrays[name] = np.load(array_path, mmap_mode='r')
+    similarity = SimilarityIndex(**arrays)
+    return manifest['version'], array, strings, similarity
+
+
+def print_overlap_report(similarity, score_dtype):
+    quantized = similarity.quantize(score_dtype)
+    overlap, max_error, mean_error = overlap_report(similarity, quantized)
+    print("{} scores vs float32 over {} markers".format(score_dtype,
+        len(similarity)))
+    print("{:>6}{:>14}{:>13}".format('top k', 'mean overlap', 'min overlap'))
+    for (k, (mean, least)) in overlap.items():
+        print("{:>6}{:>14.4f}{:>13.4f}".format(k, mean, least))
+    print("score error: max {:.5f} mean {:.5f}".format(max_error, mean_error))
+    print("scores {:.1f} MB -> {:.1f} MB, index {:.1f} MB -> {:.1f} MB".format(
+        similarity.scores.nbytes / 1e6,
+        (quantized.scores.nbytes + quantized.row_scales.nbytes) / 1e6,
+        similarity.nbytes / 1e6, quantized.nbytes / 1e6))
+
+
+async def export_snapshot(snapshot_dir, city, score_dtype, validate=False):
+    # app.dataset reads snapshots with this module
+    from app import db
+    from app.dataset import Dataset, read_dataset
+
+    await db.init_pool()
+    try:
+        dataset = await read_dataset(city, 'float32')
+    finally:
+        await db.close_pool()
+    if validate:
+        print_overlap_report(dataset.similarity, score_dtype)
+        return
+    if dataset.version is None:
+        raise SystemExit("data is unversioned, load it with the pipeline first")
+    dataset = Dataset(city, dataset.version, dataset.table,
+            dataset.similarity.quantize(score_dtype), dataset.marker_index,
+            dataset.viewport_index)
+    path = write_snapshot(dataset, snapshot_dir)
+    logger.info("wrote snapshot city=%s version=%s markers=%d scores=%s to %s",
+            city, dataset.version, len(dataset), score_dtype, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export a pastpath dataset snapshot')
+    parser.add_argument('--out', help='snapshot directory, the app\'s SNAPSHOT_DIR')
+    parser.add_argument('--city', default=get_app_settings().cities[0],
+            help='HMDB city (cty) to export, default the first of cities')
+    parser.add_argument('--score-dtype', choices=SCORE_DTYPES,
+            default=get_app_settings().similarity_score_dtype,
+            help='similarity score storage, default similarity_score_dtype')
+    parser.add_argument('--validate', action='store_true',
+            help='report top-k overlap of --score-dtype scores with float32 '
+                 'instead of writing a snapshot')
+    args = parser.parse_args()
+    if not args.validate and not args.out:
+        parser.error("--out is required unless --validate")
+    logging.basicConfig(level=logging.INFO,
+            format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    asyncio.run(export_snapshot(args.out, args.city, args.score_dtype,
+            args.validate))
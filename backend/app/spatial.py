@@ -0,0 +1,294 @@
+'''pastpath.spatial : grid indexes for nearest-marker and radius queries
+'''
+import math
+
+import numpy as np
+
+from app.markers import KM_PER_DEGREE, haversine
+
+
+class GridIndex:
+    """Markers bucketed into square cells of cell_deg degrees.
+
+    Queries only compute distances for markers in the cells that can contain
+    a match, falling back to a vectorized scan of every marker when the cells
+    to visit outnumber the occupied ones.
+    """
+
+    def __init__(self, marker_ids, lats, lons, cell_deg):
+        self.marker_ids = np.asarray(marker_ids, dtype=np.int64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_deg = cell_deg
+
+        rows = np.floor(self.lats / cell_deg).astype(np.int64)
+        cols = np.floor(self.lons / cell_deg).astype(np.int64)
+        # group marker positions by cell
+        order = np.lexsort((cols, rows))
+        keys, starts = np.unique(np.stack([rows[order], cols[order]], axis=1),
+                                 axis=0, return_index=True)
+        groups = np.split(order, starts[1:])
+        self.cells = {(int(r), int(c)): group
+                      for ((r, c), group) in zip(keys, groups)}
+        if len(self.cells):
+            self.row_range = (rows.min(), rows.max())
+            self.col_range = (cols.min(), cols.max())
+
+    def __len__(self):
+        return len(self.marker_ids)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def _gather(self, row_lo, row_hi, col_lo, col_hi):
+        """Positions of markers in cells within the (inclusive) row/col box"""
+        n_cells = (row_hi - row_lo + 1) * (col_hi - col_lo + 1)
+        if n_cells >= len(self.cells):
+            return np.arange(len(self.marker_ids))
+        found = [self.cells[(r, c)]
+                 for r in range(row_lo, row_hi + 1)
+                 for c in range(col_lo, col_hi + 1)
+                 if (r, c) in self.cells]
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(found)
+
+    def _sorted_by_distance(self, lat, lon, positions):
+        distances = haversine(lat, lon, self.lats[positions], self.lons[positions])
+        order = distances.argsort(kind='stable')
+        return positions[order], distances[order]
+
+    def query_radius(self, lat, lon, radius):
+        """Return (marker_ids, distances) within radius km, closest first"""
+        if not len(self.cells):
+            return self.marker_ids[:0], np.empty(0)
+        dlat = radius / KM_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 89.9))), 1e-6)
+        row_lo, col_lo = self._cell(lat - dlat, lon - dlon)
+        row_hi, col_hi = self._cell(lat + dlat, lon + dlon)
+        positions = self._gather(row_lo, row_hi, col_lo, col_hi)
+        positions, distances = self._sorted_by_distance(lat, lon, positions)
+        keep = distances <= radius
+        return self.marker_ids[positions[keep]], distances[keep]
+
+    def query_knn(self, lat, lon, k):
+        """Return (marker_ids, distances) of the k closest markers"""
+        k = min(k, len(self.marker_ids))
+        if k == 0:
+            return self.marker_ids[:0], np.empty(0)
+        # grow a square of cells around the query point until it holds k
+        # markers. the k-th closest of those bounds the search radius.
+        row, col = self._cell(lat, lon)
+        max_ring = max(abs(row - self.row_range[0]), abs(row - self.row_range[1]),
+                       abs(col - self.col_range[0]), abs(col - self.col_range[1]))
+        ring = 0
+        found = [self._gather(row, row, col, col)]
+        n_found = len(found[0])
+        while n_found < k and ring < max_ring:
+            ring += 1
+            if (2 * ring + 1) ** 2 >= len(self.cells):
+                found = [np.arange(len(self.marker_ids))]
+                break
+            # only visit the cells added by this ring
+            found.append(self._gather(row - ring, row - ring, col - ring, col + ring))
+            found.append(self._gather(row + ring, row + ring, col - ring, col + ring))
+            found.append(self._gather(row - ring + 1, row + ring - 1, col - ring, col - ring))
+            found.append(self._gather(row - ring + 1, row + ring - 1, col + ring, col + ring))
+            n_found = sum(len(x) for x in found)
+        positions = np.concatenate(found)
+        distances = haversine(lat, lon, self.lats[positions], self.lons[positions])
+        radius = np.partition(distances, k - 1)[k - 1]
+        marker_ids, distances = self.query_radius(lat, lon, radius)
+        return marker_ids[:k], distances[:k]
+
+
+class MarkerIndex:
+    """Spatial indexes over all markers and over each cluster (km_label)"""
+
+    def __init__(self, marker_ids, lats, lons, labels, cell_deg=0.01):
+        marker_ids = np.asarray(marker_ids, dtype=np.int64)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        labels = np.asarray(labels, dtype=np.float64)
+
+        order = np.argsort(marker_ids)
+        self.marker_ids = marker_ids[order]
+        self.lats = lats[order]
+        self.lons = lons[order]
+
+        self.all = GridIndex(marker_ids, lats, lons, cell_deg)
+        # markers without a cluster label are only in the combined index
+        self.by_label = {}
+        for label in np.unique(labels[~np.isnan(labels)]):
+            in_label = labels == label
+            self.by_label[int(label)] = GridIndex(marker_ids[in_label],
+                    lats[in_label], lons[in_label], cell_deg)
+
+    def __contains__(self, marker_id):
+        i = np.searchsorted(self.marker_ids, marker_id)
+        return i < len(self.marker_ids) and self.marker_ids[i] == marker_id
+
+    def coords(self, marker_id):
+        """Return (lat, lon) of marker_id"""
+        if marker_id not in self:
+            raise KeyError(marker_id)
+        i = np.searchsorted(self.marker_ids, marker_id)
+        return self.lats[i], self.lons[i]
+
+    def nearest(self, lat, lon, k, labels=None):
+        """Return (marker_ids, distances) of k closest markers in clusters labels
+
+        All markers are searched if labels is None.
+        """
+        if labels is None:
+            return self.all.query_knn(lat, lon, k)
+        results = [self.by_label[label].query_knn(lat, lon, k)
+                   for label in set(labels) if label in self.by_label]
+        if not results:
+            return self.all.marker_ids[:0], np.empty(0)
+        marker_ids = np.concatenate([x[0] for x in results])
+        distances = np.concatenate([x[1] for x in results])
+        order = distances.argsort(kind='stable')[:k]
+        return marker_ids[order], distances[order]
+
+    def within(self, lat, lon, radius):
+        """Return (marker_ids, distances) within radius km, closest first"""
+        return self.all.query_radius(lat, lon, radius)
+
+
+# depth of the finest grid of ViewportIndex, cells of a few meters
+QUAD_LEVEL = 24
+# map tiles are this many pixels across
+TILE_PX = 256
+
+
+def mercator(lats, lons):
+    """Web map (x, y) of points in [0, 1), with y growing southward as in tiles"""
+    lats = np.clip(np.asarray(lats, dtype=np.float64), -85.0511, 85.0511)
+    lons = np.asarray(lons, dtype=np.float64)
+    x = (lons + 180) / 360
+    y = (1 - np.arcsinh(np.tan(np.radians(lats))) / np.pi) / 2
+    top = np.nextafter(1, 0)
+    return np.clip(x, 0, top), np.clip(y, 0, top)
+
+
+def interleave(cols, rows):
+    """Morton codes of grid cells: the cells in a coarser cell are contiguous"""
+    def spread(v):
+        v = np.asarray(v, dtype=np.uint64)
+        for (shift, mask) in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                              (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                              (1, 0x5555555555555555)):
+            v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+        return v
+    return spread(cols) | (spread(rows) << np.uint64(1))
+
+
+def concat_ranges(starts, ends):
+    """np.concatenate of np.arange(start, end) for each start, end"""
+    lengths = ends - starts
+    offsets = np.cumsum(lengths)
+    if not len(offsets) or not offsets[-1]:
+        return np.empty(0, dtype=np.int64)
+    return (np.arange(offsets[-1]) - np.repeat(offsets - lengths, lengths) +
+            np.repeat(starts, lengths))
+
+
+class QuadIndex:
+    """Markers sorted along a Morton curve over a QUAD_LEVEL grid.
+
+    The markers in any cell of a coarser grid are a contiguous run, found
+    with two binary searches, and running sums of coordinates give its
+    centroid without visiting them.
+    """
+
+    def __init__(self, positions, lats, lons):
+        x, y = mercator(lats, lons)
+        n = 2 ** QUAD_LEVEL
+        keys = interleave((x * n).astype(np.uint64), (y * n).astype(np.uint64))
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.positions = np.asarray(positions, dtype=np.int64)[order]
+        self.sum_lats = np.concatenate([[0], np.cumsum(np.asarray(lats)[order])])
+        self.sum_lons = np.concatenate([[0], np.cumsum(np.asarray(lons)[order])])
+
+    def runs(self, cells, level):
+        """(start, end) of the run of markers in each cell of the grid at level"""
+        shift = np.uint64(2 * (QUAD_LEVEL - level))
+        return (np.searchsorted(self.keys, cells << shift),
+                np.searchsorted(self.keys, (cells + np.uint64(1)) << shift))
+
+
+class ViewportIndex:
+    """Markers in a map viewport, grouped into clusters when there are many.
+
+    A map at zoom z is 2**z tiles of TILE_PX pixels across. Markers are
+    clustered by grid cells of cluster_px pixels at the requested zoom,
+    aligned with the tiles, so a cluster stays put while the map is panned.
+    Positions are indexes into lats and lons.
+    """
+
+    def __init__(self, lats, lons, labels, cluster_px=64):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        labels = np.asarray(labels, dtype=np.float64)
+        positions = np.arange(len(self.lats))
+        self.level_offset = max(0, round(math.log2(TILE_PX / cluster_px)))
+
+        self.all = QuadIndex(positions, self.lats, self.lons)
+        # markers without a cluster label are only in the combined index
+        self.by_label = {}
+        for label in np.unique(labels[~np.isnan(labels)]):
+            in_label = labels == label
+            self.by_label[int(label)] = QuadIndex(positions[in_label],
+                    self.lats[in_label], self.lons[in_label])
+
+    def query(self, min_lat, min_lon, max_lat, max_lon, zoom, labels=None,
+            max_markers=500, max_cells=4096):
+        """Return (positions, clusters) of markers in the box at zoom
+
+        positions are of markers shown one by one: all of them if there are
+        at most max_markers, else those alone in their cell. clusters has a
+        row (lat, lon, count) per cell of more than one other marker. Cells
+        are coarsened until the box spans at most max_cells of them.
+        """
+        if labels is None:
+            indexes = [self.all]
+        else:
+            indexes = [self.by_label[x] for x in set(labels) if x in self.by_label]
+        x_lo, y_hi = mercator(min_lat, min_lon)
+        x_hi, y_lo = mercator(max_lat, max_lon)
+        level = min(max(zoom, 0) + self.level_offset, QUAD_LEVEL)
+        while True:
+            n = 2 ** level
+            col_lo, col_hi = int(x_lo * n), int(x_hi * n)
+            row_lo, row_hi = int(y_lo * n), int(y_hi * n)
+            n_cells = (col_hi - col_lo + 1) * (row_hi - row_lo + 1)
+            if n_cells <= max_cells or level == 0:
+                break
+            level -= 1
+        rows, cols = np.mgrid[row_lo:row_hi + 1, col_lo:col_hi + 1]
+        cells = interleave(cols.ravel(), rows.ravel())
+
+        runs = [x.runs(cells, level) for x in indexes]
+        counts = np.zeros(len(cells), dtype=np.int64)
+        for (start, end) in runs:
+            counts += end - start
+        single = (counts > 0) if counts.sum() <= max_markers else (counts == 1)
+        grouped = (counts > 1) & ~single
+
+        found = [np.empty(0, dtype=np.int64)]
+        sum_lats = np.zeros(grouped.sum())
+        sum_lons = np.zeros(grouped.sum())
+        for (index, (start, end)) in zip(indexes, runs):
+            found.append(index.positions[concat_ranges(start[single], end[single])])
+            sum_lats += index.sum_lats[end[grouped]] - index.sum_lats[start[grouped]]
+            sum_lons += index.sum_lons[end[grouped]] - index.sum_lons[start[grouped]]
+        positions = np.concatenate(found)
+        # cells on the edges reach outside the box
+        lats, lons = self.lats[positions], self.lons[positions]
+        inside = ((lats >= min_lat) & (lats <= max_lat) &
+                  (lons >= min_lon) & (lons <= max_lon))
+        n = counts[grouped]
+        clusters = np.column_stack([sum_lats / n, sum_lons / n, n])
+        return np.sort(positions[inside]), clusters
@@ -1,143 +1,453 @@
-import ast
+import asyncio
+from functools import lru_cache
+import logging
+import math
+from typing import List
 
-from fastapi import APIRouter, Request, Query
+from fastapi import APIRouter, Header, HTTPException, Request, Query
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
-import pandas as pd
-import psycopg2
+import numpy as np
+import orjson
+from starlette.concurrency import run_in_threadpool
 
+from app import db
+from app.cache import LRUCache, SingleFlight, radius_bucket
+from app.dataset import (LOAD_ERRORS, Dataset, default_city,
+        get_dataset_registry, read_nearest_markers)
+from app import metrics
 from app.markers import get_closest_starting_markers, get_top_locations_close
-from app.models import StartChoice, Marker, NearbyOptions, Route, RouteRequest
-from app.route import get_distance_matrix_response, optimal_route_from_matrix, directions_route_duration
-from app.settings import get_app_settings, get_instance_settings
+from app.models import (StartChoice, NearbyOptions, Route, RouteRequest,
+        SimilarMarker, SimilarMarkers, DatasetVersion, RouteGeometry,
+        ViewportMarkers)
+from app.route import (get_duration_matrix, optimal_route_from_matrix,
+        get_route_geometry, get_route_result_cache)
+from app.routing import get_routing_backend
+from app.metrics import count_lookups, timed
+from app.settings import get_app_settings
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-# connect to postgres
-con = psycopg2.connect(
-        database=get_app_settings().db_name,
-        user=get_instance_settings().sql_user,
-        host=get_app_settings().host,
-        port=get_app_settings().port,
-        password=get_instance_settings().sql_key
-        )
+# stops of a tour, start marker included
+TOUR_SIZE = 7
+
+
+def city_name(city):
+    # city of a request, by default the first of settings.cities
+    city = city or default_city()
+    if city not in get_app_settings().cities:
+        raise HTTPException(status_code=404, detail="unknown city")
+    return city
+
+
+def get_city_holder(city):
+    return get_dataset_registry().holder(city_name(city))
+
+
+async def get_dataset(city=None) -> Dataset:
+    # static marker data and indexes of city, loaded on its first request and
+    # swapped out when the pipeline reloads the database. handlers take one
+    # reference so they see a single version.
+    holder = get_city_holder(city)
+    try:
+        return await holder.get()
+    except LOAD_ERRORS as e:
+        logger.warning("dataset load failed city=%s: %s", holder.city, e)
+        raise HTTPException(status_code=503, detail="dataset not loaded")
+
+
+async def read_entities(city, marker_ids):
+    # display names of features per marker, as {marker_id: [display_name]}
+    query = "SELECT marker_id, display_name FROM marker_entities_table WHERE cty = $1 AND marker_id = ANY($2::bigint[]) ORDER BY marker_id, feature"
+    with timed('entity_query'):
+        rows = await db.fetch(query, city, [int(x) for x in marker_ids])
+    marker_ents = {}
+    for (marker_id, display_name) in rows:
+        marker_ents.setdefault(marker_id, []).append(display_name)
+    return marker_ents
+
+
+def map_center(markers):
+    return [sum(x.lat for x in markers) / len(markers),
+            sum(x.lon for x in markers) / len(markers)]
+
+
+def json_response(payload):
+    # payload is already serialized JSON
+    return Response(content=payload, media_type="application/json")
+
+
+@lru_cache()
+def get_start_flights() -> SingleFlight:
+    return SingleFlight()
+
+
+async def nearby_options(city, lat, lon, clusters):
+    """NearbyOptions of the markers of city closest to lat, lon in clusters,
+    as JSON"""
+    registry = get_dataset_registry()
+    dataset = registry.loaded(city)
+    with timed('nearest_markers'):
+        if dataset is not None:
+            marker_ids = get_closest_starting_markers(lat, lon,
+                    dataset.marker_index, 7, clusters)
+            markers = dataset.get_markers(marker_ids)
+        else:
+            # not loaded yet: only the few nearest rows are read from the db
+            # while the city is loaded for the requests that follow
+            registry.preload(city)
+            markers = await read_nearest_markers(city, lat, lon, 7, clusters)
+    logger.debug("choose_start clusters=%s marker_ids=%s", clusters,
+            [x.marker_id for x in markers])
+    if not markers:
+        raise HTTPException(status_code=404, detail="no markers found")
+
+    with timed('serialization'):
+        return orjson.dumps({
+            'markers': [x.display() for x in markers],
+            'map_center': map_center(markers),
+        })
 
 
-@router.post('/choose_start')
-async def choose_start(start_choice: StartChoice) -> NearbyOptions:
+@router.post('/choose_start', response_model=NearbyOptions)
+async def choose_start(start_choice: StartChoice):
     # start is limited by choice of clusters and distance from location
     clusters = start_choice.cluster
-    print("clusters: {}".format(clusters))
-
-    # get places in selected clusters
-    clusters_str = ", ".join(clusters)
-    query = "SELECT marker_id, title, lat, lon, text, categories, url, text_clean, images FROM hmdb_data_table WHERE km_label in ({});".format(clusters_str)
-    print("choose_start query: {}".format(query))
-    df_markers = pd.read_sql_query(query, con)
-    print(df_markers['text_clean'].head())
-
-    # calculate N closest markers
-    # returns rows of df_markers
-    markers = get_closest_starting_markers(start_choice.lat, start_choice.lon,
-            df_markers, 7).copy()
-    print("choose_start(): markers")
-    print(markers)
-    print(markers.columns)
-    print(markers['text_clean'].head())
-
-    # add img_src
-    img_urls = [x[0] for x in markers['images'].apply(ast.literal_eval)]
-    img_ids = [x.split("/")[-1][5:-5].zfill(6) for x in img_urls]
-    marker_id_strs = [str(x).zfill(6) for x in markers['marker_id']]
-    img_srcs = ["static/img/{}_{}_small.jpg".format(x,y) for (x,y) in zip(marker_id_strs, img_ids)]
-    markers['img_src'] = img_srcs
-    map_center = [markers.lat.mean(), markers.lon.mean()]
-
-    # convert dataframe to marker objects for json response
-    marker_objs = [Marker(**marker) for marker in markers.to_dict("records")]
-    print(f"creating nearby_options with {marker_objs}, {map_center}")
-    nearby_options = NearbyOptions(
-        markers=marker_objs,
-        map_center=map_center
-    )
-    return nearby_options
-
-
-@router.post('/output')
-async def get_route(route_request: RouteRequest) -> Route:
+
+    # calculate N closest markers in selected clusters
+    if clusters is not None:
+        clusters = sorted(set(clusters))
+    city = city_name(start_choice.city)
+    # nearby locations share a key, so a burst of requests from one place is
+    # answered by a single lookup
+    decimals = get_app_settings().start_coord_decimals
+    key = (city, round(start_choice.lat, decimals),
+           round(start_choice.lon, decimals),
+           None if clusters is None else tuple(clusters))
+    (payload,), joined = await get_start_flights().run([key],
+            lambda keys: asyncio.gather(*(nearby_options(*x) for x in keys)))
+    count_lookups('start_in_flight', joined, 1 - joined)
+    return json_response(payload)
+
+
+def select_route_markers(dataset, route_request):
+    # MarkerRecords of the tour, start marker first as the routing function
+    # requires
     radius = route_request.radius * 1.61 # convert miles to km
 
-    # get places dataframe
-    markers_query = "SELECT marker_id, title, lat, lon, text, text_clean, images, categories, url FROM hmdb_data_table WHERE cty='washington_dc';"
-    df_markers = pd.read_sql_query(markers_query, con)
-    print("get_route df_markers.head():")
-    print(df_markers.head())
-
-    # get similarities dataframe
-    sim_query = "SELECT * FROM similarities_data_table"
-    df_similarities = pd.read_sql_query(sim_query, con, index_col='marker_id')
-    print("get_route df_similarities.head():")
-    print(df_similarities.head())
-
-    top_n_id = get_top_locations_close(route_request.start_marker, df_similarities, 7,
-            df_markers, radius)
-    print("get_route top_n_id:")
-    print(top_n_id)
-    # routing function requires having the start/end point first.
-    # first entry in top_n_id should always start_marker since it has highest
-    # similarity with itself
-    # start with first marker and then add the rest
-    markers = df_markers[df_markers.marker_id==top_n_id[0]]
-    markers = markers.append(df_markers[df_markers.marker_id.isin(top_n_id[1:])])
-
-    map_center = [markers.lat.mean(), markers.lon.mean()]
-    marker_coords = [(x.lon, x.lat) for x in markers.itertuples()]
-    print(marker_coords)
-
-    marker_names = [x.text[:30] for x in markers.itertuples()]
-
-    # solve TSP
-    dist_matrix_response = get_distance_matrix_response(marker_coords)
-    dist_matrix = dist_matrix_response["durations"]
-    optimal_coords, marker_order, _ = optimal_route_from_matrix(marker_coords,
-        marker_names, dist_matrix, start=0)
-    optimal_route, optimal_duration = directions_route_duration(optimal_coords)
-    optimal_duration = int(optimal_duration)
-    # reorder marker order to reflect walking tour order
-    markers = markers.reset_index().reindex(marker_order)
-    route_str = " ⇨ ".join(markers.title)
-
-    # get entities (2 tables due to number of columns)
-    marker_ids_str = ", ".join(markers.marker_id.values.astype(str))
-    ent_query_1 = "SELECT * FROM entities_data_table_1 WHERE marker_id IN ({})".format(marker_ids_str)
-    df_ent_1 = pd.read_sql_query(ent_query_1, con, index_col='marker_id')
-    ent_query_2 = "SELECT * FROM entities_data_table_2 WHERE marker_id IN ({})".format(marker_ids_str)
-    df_ent_2 = pd.read_sql_query(ent_query_2, con, index_col='marker_id')
-    df_ent = df_ent_1.merge(df_ent_2, how='outer', on='marker_id')
-    marker_ents = []
-    for marker_id in markers.marker_id.values:
-        raw_one_marker_ents = df_ent.columns[df_ent.loc[marker_id]!=0].tolist()
-        one_marker_ents = [x.split("_")[0].capitalize() for x in raw_one_marker_ents]
-        marker_ents.append(one_marker_ents)
-    markers['marker_ents'] = marker_ents
+    with timed('similarity_filter'):
+        top_n_id = get_top_locations_close(route_request.start_marker,
+                dataset.similarity, TOUR_SIZE, dataset.marker_index, radius)
+    logger.debug("route start_marker=%s radius=%s stops=%s",
+            route_request.start_marker, route_request.radius, top_n_id)
+    return dataset.get_markers(top_n_id)
+
+
+def make_route_id(stop_ids):
+    # the ordered stops identify a route, so any worker can build its geometry
+    return "-".join(str(int(x)) for x in stop_ids)
+
+
+def parse_route_id(route_id):
+    # stop ids of a route_id made by make_route_id. no tour has more than
+    # TOUR_SIZE stops or visits one twice, so other ids are not routed
+    try:
+        stop_ids = [int(x) for x in route_id.split("-")]
+    except ValueError:
+        raise HTTPException(status_code=404, detail="route not found")
+    if len(stop_ids) > TOUR_SIZE or len(set(stop_ids)) < len(stop_ids):
+        raise HTTPException(status_code=404, detail="route not found")
+    return stop_ids
+
+
+async def solve_route(markers, dist_matrix):
+    marker_coords = [(x.lon, x.lat) for x in markers]
+    marker_names = [x.text[:30] for x in markers]
+
+    # solve TSP in threadpool to keep it off the event loop
+    with timed('tsp_solve'):
+        _, marker_order, _ = await run_in_threadpool(
+            optimal_route_from_matrix, marker_coords, marker_names, dist_matrix,
+            start=0)
+    return marker_order
+
+
+async def order_routes(dataset, route_requests):
+    """(markers, marker_order) of the tour for each of route_requests
+
+    Durations come from one matrix over the union of all tours' stops, and
+    the tours are solved concurrently.
+    """
+    stop_markers = [select_route_markers(dataset, x) for x in route_requests]
+
+    # deduplicate markers shared between tours
+    union = list({x.marker_id: x for markers in stop_markers
+                  for x in markers}.values())
+    union_ids = [x.marker_id for x in union]
+    union_coords = [(x.lon, x.lat) for x in union]
+    union_matrix = np.array(await get_duration_matrix(union_ids, union_coords),
+            dtype=np.float64)
+    position = {x: i for (i, x) in enumerate(union_ids)}
+
+    def sub_matrix(markers):
+        idx = [position[x.marker_id] for x in markers]
+        return union_matrix[np.ix_(idx, idx)]
+    orders = await asyncio.gather(*(solve_route(markers, sub_matrix(markers))
+                                    for markers in stop_markers))
+    return list(zip(stop_markers, orders))
+
+
+def in_order(markers, marker_order):
+    # reorder markers to reflect walking tour order
+    return [markers[i] for i in marker_order]
+
 
+async def route_geometry(markers):
+    """(route_polylines, optimal_duration) of walking tour through markers"""
+    stop_ids = [x.marker_id for x in markers]
+    coords = [(x.lon, x.lat) for x in markers]
+    # tour returns to the start
+    route_coords, optimal_duration = await get_route_geometry(
+        stop_ids + stop_ids[:1], coords + coords[:1])
     # decode route to geojson-ready form
-    route_polylines_flip = optimal_route['features'][0]['geometry']['coordinates']
-    route_polylines = [[y,x] for [x,y] in route_polylines_flip]
-
-    # add img_src
-    img_urls = [x[0] for x in markers['images'].apply(ast.literal_eval)]
-    img_ids = [x.split("/")[-1][5:-5].zfill(6) for x in img_urls]
-    marker_id_strs = [str(x).zfill(6) for x in markers['marker_id']]
-    img_srcs = ["static/img/{}_{}_small.jpg".format(x,y) for (x,y) in zip(marker_id_strs, img_ids)]
-    markers['img_src'] = img_srcs
-
-    marker_objs = [Marker(**marker) for marker in markers.to_dict("records")]
-    route = Route(
-        markers=marker_objs,
-        map_center=map_center,
-        route_polylines=route_polylines,
-        marker_order=marker_order,
-        route_str=route_str,
-        optimal_duration=optimal_duration
-    )
-    return route
+    route_polylines = [[y,x] for [x,y] in route_coords]
+    return route_polylines, int(optimal_duration)
+
+
+async def read_tour_entities(city, tours):
+    return await read_entities(city, {x.marker_id for (markers, _) in tours
+                                      for x in markers})
+
+
+def make_route(markers, marker_order, ents, geometry=(None, None)):
+    """Fields of the Route response model, as a dict ready to serialize"""
+    center = map_center(markers)
+    markers = in_order(markers, marker_order)
+    route_polylines, optimal_duration = geometry
+    return {
+        'markers': [x.display(ents.get(x.marker_id, [])) for x in markers],
+        'map_center': center,
+        'route_polylines': route_polylines,
+        'marker_order': marker_order,
+        'route_str': " ⇨ ".join(x.title for x in markers),
+        'optimal_duration': optimal_duration,
+        'route_id': make_route_id(x.marker_id for x in markers),
+    }
+
+
+async def build_routes(dataset, route_requests):
+    """Route (as a dict) for each of route_requests"""
+    tours = await order_routes(dataset, route_requests)
+    geometries = await asyncio.gather(*(route_geometry(in_order(markers, order))
+                                        for (markers, order) in tours))
+    ents = await read_tour_entities(dataset.city, tours)
+    return [make_route(markers, order, ents, geometry)
+            for ((markers, order), geometry) in zip(tours, geometries)]
+
+
+def dumps(route):
+    return orjson.dumps(route).decode()
+
+
+@lru_cache()
+def get_pending_geometry() -> LRUCache:
+    # route_id: task finishing a route returned stops_first by this worker
+    return LRUCache(1000, ttl=600)
+
+
+async def finish_route(version, key, route, markers):
+    """Build geometry of stops_first route, store the whole route, return geometry"""
+    try:
+        geometry = await route_geometry(markers)
+    except Exception as e:
+        logger.warning("finish_route failed route_id=%s: %s", route['route_id'], e)
+        return None
+    route = dict(route, route_polylines=geometry[0], optimal_duration=geometry[1])
+    if version is not None:
+        # the geometry is still returned if the route can't be cached
+        try:
+            await get_route_result_cache().put_many(version,
+                    {key: dumps(route)}, get_routing_backend().profile)
+        except Exception as e:
+            logger.warning("finish_route cache write failed route_id=%s: %s",
+                           route['route_id'], e)
+    return geometry
+
+
+@lru_cache()
+def get_route_flights() -> SingleFlight:
+    return SingleFlight()
+
+
+async def build_payloads(dataset, keys, stops_first=False):
+    """Route as JSON for each (start_marker, radius bucket) of keys, cached"""
+    cache = get_route_result_cache()
+    route_requests = [RouteRequest(start_marker=x, radius=y / 100)
+                      for (x, y) in keys]
+    if stops_first:
+        payloads = []
+        tours = await order_routes(dataset, route_requests)
+        ents = await read_tour_entities(dataset.city, tours)
+        for (key, (markers, order)) in zip(keys, tours):
+            route = make_route(markers, order, ents)
+            task = asyncio.create_task(finish_route(dataset.version, key, route,
+                                                    in_order(markers, order)))
+            get_pending_geometry().put(route['route_id'], task)
+            payloads.append(dumps(route))
+        return payloads
+
+    built = await build_routes(dataset, route_requests)
+    with timed('serialization'):
+        payloads = [dumps(route) for route in built]
+    if dataset.version is not None:
+        await cache.put_many(dataset.version, dict(zip(keys, payloads)),
+                get_routing_backend().profile)
+    return payloads
+
+
+async def get_routes(dataset, route_requests, stops_first=False):
+    """Route for each of route_requests (from markers of dataset's city) as
+    JSON, built only if not already cached
+
+    Radii are rounded to radius buckets, so identical requests share a route.
+    With stops_first, routes that are not cached are returned without their
+    geometry, which is built and cached in the background.
+    """
+    # checked before the cache, which is keyed by marker and not by city, so
+    # a marker of another city isn't answered with that city's route
+    for x in route_requests:
+        if x.start_marker not in dataset.marker_index:
+            raise HTTPException(status_code=404,
+                    detail="marker {} not found".format(x.start_marker))
+    cache = get_route_result_cache()
+    profile = get_routing_backend().profile
+    keys = [(x.start_marker, radius_bucket(x.radius)) for x in route_requests]
+    # an unversioned dataset can't tell when cached routes go stale
+    payloads = {}
+    if dataset.version is not None:
+        with timed('route_cache_lookup'):
+            payloads = await cache.get_many(dataset.version, set(keys), profile)
+    missing = [key for key in dict.fromkeys(keys) if key not in payloads]
+    count_lookups('route_result', len(payloads), len(missing))
+    if missing:
+        # requests for routes being built by another request wait for them
+        flight_keys = [(dataset.city, dataset.version, stops_first) + x
+                       for x in missing]
+        new_payloads, joined = await get_route_flights().run(flight_keys,
+                lambda keys: build_payloads(dataset, [x[3:] for x in keys],
+                                            stops_first))
+        count_lookups('route_in_flight', joined, len(missing) - joined)
+        payloads.update(zip(missing, new_payloads))
+    return [payloads[key] for key in keys]
+
+
+@router.post('/output', response_model=Route)
+async def get_route(route_request: RouteRequest):
+    routes = await get_routes(await get_dataset(route_request.city),
+            [route_request], route_request.stops_first)
+    return json_response(routes[0])
+
+
+@router.get('/routes/{route_id}/geometry', response_model=RouteGeometry)
+async def get_route_geometry_by_id(route_id: str, city: str = None):
+    geometry = None
+    task = get_pending_geometry().get(route_id)
+    if task is not None:
+        # shielded so a client disconnecting doesn't cancel it for others
+        geometry = await asyncio.shield(task)
+    if geometry is None:
+        # route from another worker, or its background task failed
+        stop_ids = parse_route_id(route_id)
+        dataset = await get_dataset(city)
+        if not all(x in dataset.marker_index for x in stop_ids):
+            raise HTTPException(status_code=404, detail="route not found")
+        geometry = await route_geometry(dataset.get_markers(stop_ids))
+    route_polylines, optimal_duration = geometry
+    return ORJSONResponse({'route_id': route_id,
+                           'route_polylines': route_polylines,
+                           'optimal_duration': optimal_duration})
+
+
+@router.post('/routes/batch', response_model=List[Route])
+async def get_routes_batch(route_requests: List[RouteRequest]):
+    max_routes = get_app_settings().max_batch_routes
+    if len(route_requests) > max_routes:
+        raise HTTPException(status_code=422,
+                detail="at most {} routes per batch".format(max_routes))
+    # routes of each city are built together from that city's dataset
+    positions = {}
+    for (i, x) in enumerate(route_requests):
+        positions.setdefault(city_name(x.city), []).append(i)
+    routes = [None] * len(route_requests)
+    for (city, city_positions) in positions.items():
+        city_routes = await get_routes(await get_dataset(city),
+                [route_requests[i] for i in city_positions])
+        for (i, route) in zip(city_positions, city_routes):
+            routes[i] = route
+    return json_response("[" + ",".join(routes) + "]")
+
+
+@router.get('/markers', response_model=ViewportMarkers)
+async def get_viewport_markers(bbox: str, zoom: int = Query(..., ge=0, le=24),
+        clusters: str = None, city: str = None):
+    # bbox is min_lon,min_lat,max_lon,max_lat, as from leaflet's toBBoxString
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(x) for x in bbox.split(","))
+        labels = None
+        if clusters:
+            labels = [int(x) for x in clusters.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=422, detail="bad bbox or clusters")
+    if (not all(math.isfinite(x) for x in (min_lon, min_lat, max_lon, max_lat))
+            or min_lon > max_lon or min_lat > max_lat):
+        raise HTTPException(status_code=422, detail="bad bbox")
+
+    dataset = await get_dataset(city)
+    settings = get_app_settings()
+    with timed('viewport_query'):
+        positions, groups = dataset.viewport_index.query(min_lat, min_lon,
+                max_lat, max_lon, zoom, labels, settings.viewport_max_markers,
+                settings.viewport_max_cells)
+    with timed('serialization'):
+        rows = dataset.table.array[positions]
+        km_labels = [None if math.isnan(x) else int(x)
+                     for x in rows['km_label'].tolist()]
+        titles = [dataset.table.string('title', i) for i in positions.tolist()]
+        markers = [list(x) for x in zip(rows['marker_id'].tolist(),
+                   rows['lat'].tolist(), rows['lon'].tolist(), km_labels, titles)]
+        return ORJSONResponse({'zoom': zoom, 'markers': markers,
+                               'clusters': [[lat, lon, int(n)] for (lat, lon, n)
+                                            in groups.tolist()]})
+
+
+@router.get('/markers/{marker_id}/similar')
+async def get_similar_markers(marker_id: int, k: int = Query(10, gt=0),
+        city: str = None) -> SimilarMarkers:
+    sim_index = (await get_dataset(city)).similarity
+    if marker_id not in sim_index:
+        raise HTTPException(status_code=404, detail="marker not found")
+    neighbor_ids, scores = sim_index.neighbors(marker_id, k, include_self=False)
+    similar = [SimilarMarker(marker_id=x, score=y)
+            for (x, y) in zip(neighbor_ids.tolist(), scores.tolist())]
+    return SimilarMarkers(marker_id=marker_id, similar=similar)
+
+
+@router.post('/admin/reload')
+async def reload_dataset(force: bool = False, city: str = None,
+        x_admin_token: str = Header(None)) -> DatasetVersion:
+    # swap in the latest data without restarting workers (each worker also
+    # polls for new versions every dataset_poll_interval seconds)
+    admin_token = get_app_settings().admin_token
+    if not admin_token or x_admin_token != admin_token:
+        raise HTTPException(status_code=403, detail="forbidden")
+    dataset = await get_city_holder(city).reload(force)
+    return DatasetVersion(version=dataset.version)
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text exposition format, for this worker process
+    return PlainTextResponse(metrics.render(),
+            media_type="text/plain; version=0.0.4")
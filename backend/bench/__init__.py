@@ -0,0 +1,9 @@
+'''bench : load testing the backend against synthetic data and a fake ORS
+
+Run from backend/, against a scratch database (the app's env vars select it):
+
+    python -m bench.seed --markers 20000 --replace
+    python -m bench.fake_ors --port 8090
+    ORS_BASE_URL=http://localhost:8090 uvicorn app.main:app --port 8000
+    python -m bench.load --url http://localhost:8000 --markers 20000
+'''
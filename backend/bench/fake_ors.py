@@ -0,0 +1,70 @@
+'''bench.fake_ors : stand-in for the OpenRouteService matrix and directions APIs
+
+Answers are deterministic: durations come from the local routing backend's
+straight-line estimate, and each leg's geometry is a straight line broken into
+evenly spaced points, so responses are about the size of real ones. Point the
+app at it with ORS_BASE_URL.
+'''
+import argparse
+import asyncio
+
+from fastapi import Body, FastAPI
+import numpy as np
+import uvicorn
+
+from app.routing import LocalBackend
+
+WALKING_SPEED = 1.3
+DETOUR_FACTOR = 1.3
+
+app = FastAPI()
+app.state.matrix_latency = 0
+app.state.directions_latency = 0
+app.state.points_per_leg = 20
+
+backend = LocalBackend(WALKING_SPEED, DETOUR_FACTOR)
+
+
+@app.post('/v2/matrix/{profile}/json')
+async def matrix(profile: str, body: dict = Body(...)):
+    await asyncio.sleep(app.state.matrix_latency)
+    durations = backend.durations(body['locations'], body.get('sources'),
+            body.get('destinations'))
+    return {'durations': durations.tolist()}
+
+
+@app.post('/v2/directions/{profile}/geojson')
+async def directions(profile: str, body: dict = Body(...)):
+    await asyncio.sleep(app.state.directions_latency)
+    stops = np.asarray(body['coordinates'], dtype=np.float64)
+    leg_durations = np.diag(backend.durations(stops), 1).tolist()
+
+    n = app.state.points_per_leg
+    steps = np.linspace(0, 1, n, endpoint=False)[:, None]
+    coords = [stops[i] + steps * (stops[i + 1] - stops[i])
+              for i in range(len(stops) - 1)]
+    coords = np.vstack(coords + [stops[-1:]]).tolist()
+    return {'type': 'FeatureCollection', 'features': [{
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': coords},
+        'properties': {
+            'summary': {'duration': sum(leg_durations)},
+            'way_points': list(range(0, len(coords), n)),
+            'segments': [{'duration': x} for x in leg_durations],
+            },
+        }]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fake OpenRouteService')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--matrix-latency', type=float, default=0,
+            help='seconds added to each matrix response')
+    parser.add_argument('--directions-latency', type=float, default=0,
+            help='seconds added to each directions response')
+    parser.add_argument('--points-per-leg', type=int, default=20)
+    args = parser.parse_args()
+    app.state.matrix_latency = args.matrix_latency
+    app.state.directions_latency = args.directions_latency
+    app.state.points_per_leg = args.points_per_leg
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning')
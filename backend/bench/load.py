@@ -0,0 +1,154 @@
+'''bench.load : drive concurrent requests at the API and report latencies
+
+Each worker sends requests back to back, picking the endpoint at random by
+weight. Start markers are drawn from ids first_id..first_id+markers-1 as
+written by bench.seed for --city (by default the app's default city).
+'''
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+import httpx
+import numpy as np
+
+from bench.seed import BBOX, N_CLUSTERS
+
+
+def start_marker(rng, args):
+    return rng.randint(args.first_id, args.first_id + args.markers - 1)
+
+
+def city_query(args, sep='?'):
+    return sep + 'city=' + args.city if args.city else ''
+
+
+def choose_start_request(rng, args):
+    clusters = rng.sample(range(N_CLUSTERS), 3)
+    return 'POST', '/choose_start', {
+        'lat': rng.uniform(BBOX[0], BBOX[1]),
+        'lon': rng.uniform(BBOX[2], BBOX[3]),
+        'cluster': [str(x) for x in clusters], 'city': args.city}
+
+
+def output_request(rng, args):
+    # radii off the presets miss the route result cache
+    radius = rng.choice(args.radii) if args.radii else round(rng.uniform(0.25, 3), 2)
+    return 'POST', '/output', {'start_marker': start_marker(rng, args),
+                               'radius': radius, 'city': args.city}
+
+
+def similar_request(rng, args):
+    return 'GET', '/markers/{}/similar{}'.format(start_marker(rng, args),
+                                                 city_query(args)), None
+
+
+def viewport_request(rng, args):
+    # a 1280 x 800 pixel map, 2**zoom 256 pixel tiles across the world
+    zoom = rng.randint(11, 17)
+    lat = rng.uniform(BBOX[0], BBOX[1])
+    lon = rng.uniform(BBOX[2], BBOX[3])
+    dlon = 360 / 2 ** zoom * 1280 / 256 / 2
+    dlat = dlon * 800 / 1280 * math.cos(math.radians(lat))
+    bbox = "{},{},{},{}".format(lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+    return 'GET', '/markers?bbox={}&zoom={}{}'.format(bbox, zoom,
+            city_query(args, '&')), None
+
+
+ENDPOINTS = {
+    'choose_start': choose_start_request,
+    'output': output_request,
+    'similar': similar_request,
+    'viewport': viewport_request,
+}
+
+
+async def worker(client, rng, args, deadline, results):
+    names = list(args.mix)
+    weights = [args.mix[x] for x in names]
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights)[0]
+        method, path, body = ENDPOINTS[name](rng, args)
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, path, json=body)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            ok = False
+        results.append((name, time.perf_counter() - start, ok))
+
+
+def summarize(results, elapsed):
+    summary = {}
+    for name in sorted({x[0] for x in results}):
+        latencies = np.array([x[1] for x in results if x[0] == name])
+        errors = sum(1 for x in results if x[0] == name and not x[2])
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        summary[name] = {'requests': len(latencies), 'errors': errors,
+                         'rps': len(latencies) / elapsed,
+                         'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+    return summary
+
+
+async def run_load(args):
+    results = []
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits,
+                                 timeout=args.timeout) as client:
+        # warm up so dataset loading and first-request costs aren't measured
+        warmup_deadline = time.perf_counter() + args.warmup
+        await asyncio.gather(*(worker(client, random.Random(args.seed - i - 1),
+                                      args, warmup_deadline, [])
+                               for i in range(args.concurrency)))
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*(worker(client, random.Random(args.seed + i), args,
+                                      deadline, results)
+                               for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    return summarize(results, elapsed)
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError("unknown endpoint {}".format(name))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load test the pastpath api')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--markers', type=int, default=2000,
+            help='number of markers seeded by bench.seed')
+    parser.add_argument('--first-id', type=int, default=1,
+            help='id of the first marker seeded by bench.seed')
+    parser.add_argument('--city', help='city of the markers, default the app\'s')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--mix', type=parse_mix,
+            default=parse_mix('choose_start=1,output=1'),
+            help='endpoint weights, e.g. choose_start=3,output=1,similar=1')
+    parser.add_argument('--radii', type=float, nargs='*', default=None,
+            help='radii for /output (default: random, mostly uncached)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write summary to this file')
+    args = parser.parse_args()
+
+    summary = asyncio.run(run_load(args))
+    print("{:<14}{:>9}{:>8}{:>9}{:>10}{:>10}{:>10}".format(
+        'endpoint', 'requests', 'errors', 'rps', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for (name, x) in summary.items():
+        print("{:<14}{:>9}{:>8}{:>9.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            name, x['requests'], x['errors'], x['rps'], x['p50_ms'],
+            x['p95_ms'], x['p99_ms']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
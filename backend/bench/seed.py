@@ -0,0 +1,187 @@
+'''bench.seed : fill the database with a synthetic marker dataset
+
+Markers of a city get ids first_id..first_id+n-1, random positions around
+Washington, DC and random cluster labels, and are written as the city's
+partitions of the tables (other cities are left alone). Half of each marker's
+similarity neighbors are markers close to it in longitude order, so tours
+find similar stops within walking radius, and half are drawn from anywhere.
+'''
+import argparse
+import asyncio
+from datetime import datetime
+import re
+
+import numpy as np
+
+from app import db
+from app.dataset import MARKER_COLUMNS
+from app.route import get_duration_cache
+from app.settings import get_app_settings
+
+# lat_min, lat_max, lon_min, lon_max
+BBOX = (38.80, 38.99, -77.12, -76.91)
+N_CLUSTERS = 10
+N_FEATURES = 500
+WORDS = ('memorial house church street war union school park river civil '
+         'railroad market freedom canal hotel fort bridge avenue capitol '
+         'hospital').split()
+
+# partitioned on cty, like the tables written by scripts/db.py
+TABLES = """
+CREATE TABLE IF NOT EXISTS hmdb_data_table (
+    marker_id bigint, title text, lat double precision, lon double precision,
+    text text, text_clean text, img_src text, url text, km_label bigint,
+    cty text) PARTITION BY LIST (cty);
+CREATE TABLE IF NOT EXISTS similarity_neighbors_table (
+    marker_id bigint, neighbor_id bigint, score double precision, cty text)
+    PARTITION BY LIST (cty);
+CREATE TABLE IF NOT EXISTS marker_entities_table (
+    marker_id bigint, feature text, feature_type text, display_name text,
+    cty text) PARTITION BY LIST (cty);
+CREATE TABLE IF NOT EXISTS data_version_table (
+    version text, loaded_at timestamp, cty text);
+CREATE INDEX IF NOT EXISTS ix_hmdb_data_table_marker_id
+    ON hmdb_data_table (marker_id);
+CREATE INDEX IF NOT EXISTS ix_hmdb_data_table_lat_lon
+    ON hmdb_data_table (lat, lon);
+CREATE INDEX IF NOT EXISTS ix_similarity_neighbors_table_marker_id_score_DESC
+    ON similarity_neighbors_table (marker_id, score DESC);
+CREATE INDEX IF NOT EXISTS ix_marker_entities_table_marker_id
+    ON marker_entities_table (marker_id);
+"""
+PARTITIONED_TABLES = ['hmdb_data_table', 'similarity_neighbors_table',
+                      'marker_entities_table']
+
+
+def partition_name(table, city):
+    return "{}_{}".format(table, re.sub(r"\W", "_", city.lower()))
+
+
+def make_markers(n, city, first_id, rng):
+    """Records of MARKER_COLUMNS plus cty"""
+    marker_ids = np.arange(first_id, first_id + n)
+    lats = rng.uniform(BBOX[0], BBOX[1], n)
+    lons = rng.uniform(BBOX[2], BBOX[3], n)
+    labels = rng.integers(0, N_CLUSTERS, n)
+    words = rng.choice(WORDS, (n, 40))
+    records = []
+    for (i, marker_id) in enumerate(marker_ids.tolist()):
+        text = " ".join(words[i])
+        records.append((marker_id, "Marker {}".format(marker_id),
+                        float(lats[i]), float(lons[i]), text, text, None,
+                        "https://www.hmdb.org/m.asp?m={}".format(marker_id),
+                        int(labels[i]), city))
+    return records, lons
+
+
+def make_neighbors(lons, k, first_id, rng):
+    """(marker_ids, neighbor_ids, scores) with up to k neighbors per marker,
+    each listed once"""
+    n = len(lons)
+    by_lon = np.argsort(lons)
+    rank = np.empty(n, dtype=np.int64)
+    rank[by_lon] = np.arange(n)
+
+    near = k // 2
+    offsets = rng.integers(-200, 201, (n, near))
+    near_ids = by_lon[np.clip(rank[:, None] + offsets, 0, n - 1)]
+    far_ids = rng.integers(0, n, (n, k - near))
+    neighbor_pos = np.hstack([np.arange(n)[:, None], near_ids, far_ids])
+    scores = np.sort(rng.uniform(0, 0.9, neighbor_pos.shape), axis=1)[:, ::-1]
+    # every marker is its own most similar neighbor
+    scores[:, 0] = 1
+    # samples repeating an earlier neighbor of their row (or the marker) are
+    # dropped. the sort is stable, so the first of equal neighbors is kept
+    order = np.argsort(neighbor_pos, axis=1, kind='stable')
+    sorted_pos = np.take_along_axis(neighbor_pos, order, axis=1)
+    repeat = np.zeros(neighbor_pos.shape, dtype=bool)
+    np.put_along_axis(repeat, order[:, 1:],
+                      sorted_pos[:, 1:] == sorted_pos[:, :-1], axis=1)
+    keep = ~repeat.ravel()
+    marker_pos = np.repeat(np.arange(n), neighbor_pos.shape[1])
+    return (marker_pos[keep] + first_id, neighbor_pos.ravel()[keep] + first_id,
+            scores.ravel()[keep])
+
+
+def make_entities(n, city, first_id, rng):
+    records = []
+    counts = rng.integers(3, 9, n)
+    for (marker_id, count) in zip(range(first_id, first_id + n), counts.tolist()):
+        for feature in sorted(set(rng.integers(0, N_FEATURES, count).tolist())):
+            records.append((marker_id, "ne_f{}".format(feature), 'named_entity',
+                            "Feature {}".format(feature), city))
+    return records
+
+
+async def seed(n_markers, n_neighbors, city, first_id=1, random_seed=0,
+        replace=False):
+    rng = np.random.default_rng(random_seed)
+    await db.init_pool()
+    try:
+        partition = partition_name('hmdb_data_table', city)
+        exists = await db.fetch("SELECT to_regclass($1) IS NOT NULL", partition)
+        if exists[0][0] and not replace:
+            raise SystemExit("{} exists, pass --replace to overwrite it".format(
+                partition))
+        kind = await db.fetch("SELECT relkind::text FROM pg_class "
+                "WHERE oid = to_regclass('hmdb_data_table')")
+        if kind and kind[0][0] != 'p' and not replace:
+            raise SystemExit("hmdb_data_table isn't partitioned by city, pass "
+                             "--replace to overwrite it")
+
+        markers, lons = make_markers(n_markers, city, first_id, rng)
+        marker_ids, neighbor_ids, scores = make_neighbors(lons, n_neighbors,
+                first_id, rng)
+        entities = make_entities(n_markers, city, first_id, rng)
+
+        async with db.get_pool().acquire() as conn:
+            async with conn.transaction():
+                if kind and kind[0][0] != 'p':
+                    await conn.execute("DROP TABLE IF EXISTS {}, data_version_table".format(
+                            ", ".join(PARTITIONED_TABLES)))
+                await conn.execute(TABLES)
+                for table in PARTITIONED_TABLES:
+                    await conn.execute("DROP TABLE IF EXISTS {}".format(
+                            partition_name(table, city)))
+                    await conn.execute(
+                            "CREATE TABLE {} PARTITION OF {} FOR VALUES IN ('{}')".format(
+                            partition_name(table, city), table,
+                            city.replace("'", "''")))
+                await conn.copy_records_to_table('hmdb_data_table', records=markers,
+                        columns=MARKER_COLUMNS + ['cty'])
+                await conn.copy_records_to_table('similarity_neighbors_table',
+                        records=zip(marker_ids.tolist(), neighbor_ids.tolist(),
+                                    scores.tolist(), [city] * len(marker_ids)))
+                await conn.copy_records_to_table('marker_entities_table',
+                        records=entities)
+
+        # cached durations belong to the old markers with the same ids
+        await get_duration_cache().create_table()
+        await db.execute("DELETE FROM {} WHERE from_marker BETWEEN $1 AND $2 "
+                "OR to_marker BETWEEN $1 AND $2".format(get_duration_cache().table),
+                first_id, first_id + n_markers - 1)
+        loaded_at = datetime.utcnow()
+        version = "bench" + loaded_at.strftime("%Y%m%dT%H%M%S")
+        await db.execute("INSERT INTO data_version_table VALUES ($1, $2, $3)",
+                version, loaded_at, city)
+        print("seeded {} markers of {}, {} neighbor rows, {} entity rows as version {}".format(
+            len(markers), city, len(marker_ids), len(entities), version))
+    finally:
+        await db.close_pool()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='seed synthetic pastpath data')
+    parser.add_argument('--markers', type=int, default=2000)
+    parser.add_argument('--neighbors', type=int, default=50,
+            help='similarity neighbors per marker')
+    parser.add_argument('--city', default=get_app_settings().cities[0],
+            help='city (cty) to seed, default the first of cities')
+    parser.add_argument('--first-id', type=int, default=1,
+            help='id of the first marker, ids are unique across cities')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--replace', action='store_true',
+            help='drop existing marker tables')
+    args = parser.parse_args()
+    asyncio.run(seed(args.markers, args.neighbors, args.city, args.first_id,
+            args.seed, args.replace))
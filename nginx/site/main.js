@@ -1,6 +1,11 @@
+// HMDB city (cty) of the markers, from ?city= (the api's default if not
+// given), and where the map starts for it
+var city = new URLSearchParams(window.location.search).get("city");
+var city_centers = {washington_dc: [38.8977, -77.033]};
+var city_center = city_centers[city || "washington_dc"] || city_centers["washington_dc"];
+
 // set up leaflet map
-var dc_center = [38.8977, -77.033];
-var map = L.map('map').setView(dc_center, 14);
+var map = L.map('map').setView(city_center, 14);
 
 var layer = L.tileLayer('http://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png', {
 attribution: '&copy; <a href="http://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors, &copy; <a href="http://cartodb.com/attributions">CartoDB</a>'
@@ -9,7 +14,7 @@ attribution: '&copy; <a href="http://www.openstreetmap.org/copyright">OpenStreet
 map.addLayer(layer);
 
 // use mouse click on map to id user location
-var popup = L.marker(dc_center).addTo(map);
+var popup = L.marker(city_center).addTo(map);
 function onMapClick(e) {
     popup
         .setLatLng(e.latlng)
@@ -19,6 +24,47 @@ function onMapClick(e) {
 }
 map.on('click', onMapClick);
 
+// all markers in view, grouped into clusters where they are too many to show
+var viewportLayer = L.layerGroup().addTo(map);
+var viewportRequest = 0;
+function showViewportMarkers() {
+    var clusters = $("input[name='cluster']:checked").map(function () {
+        return this.value;
+    }).get();
+    var params = {bbox: map.getBounds().toBBoxString(), zoom: map.getZoom()};
+    if (city) {
+        params["city"] = city;
+    }
+    if (clusters.length > 0) {
+        params["clusters"] = clusters.join(",");
+    }
+    // answers to earlier requests may come after later ones while panning
+    var request = ++viewportRequest;
+    $.getJSON("api/v1/markers", params)
+      .done(function (data) {
+          if (request != viewportRequest) {
+              return;
+          }
+          viewportLayer.clearLayers();
+          data["clusters"].forEach(function (cluster) {
+              L.circleMarker([cluster[0], cluster[1]],
+                  {radius: 6 + 4 * Math.log10(cluster[2]), color: 'grey',
+                   weight: 1, fillOpacity: 0.4})
+                .bindPopup(cluster[2] + " markers, zoom in to see them")
+                .addTo(viewportLayer);
+          });
+          data["markers"].forEach(function (marker) {
+              L.circleMarker([marker[1], marker[2]],
+                  {radius: 4, color: 'grey', weight: 1, fillOpacity: 0.8})
+                .bindPopup(marker[4])
+                .addTo(viewportLayer);
+          });
+      });
+}
+map.on('moveend', showViewportMarkers);
+$("input[name='cluster']").change(showViewportMarkers);
+showViewportMarkers();
+
 // generic ajax post request with json returned datatype
 makePostCall = function (url, data) {
     var json_data = JSON.stringify(data);
@@ -90,6 +136,7 @@ $("#inputForm").submit(function(e) {
           data[obj.name] = obj.value;
         }
     });
+    data["city"] = city;
     // todo fix hard-coded url to call
     var url = form.attr('action');
     makePostCall(url, data)
@@ -123,6 +170,9 @@ $("#chooseStart").submit(function(e) {
     $(formdata ).each(function(index, obj){
          data[obj.name] = obj.value;
     });
+    // show the stops as soon as they are chosen, walking path follows
+    data["stops_first"] = true;
+    data["city"] = city;
 
     // update display to loading state
     $(window).scrollTop(0);
@@ -136,13 +186,24 @@ $("#chooseStart").submit(function(e) {
           console.log("made call! status:", textStatus);
           console.log(data);
           $("#loadingDonut").addClass("inactive");
-          showRouteMap(data["markers"], data["route_polylines"]);
+          showRouteMarkers(data["markers"]);
           $("#stepthree").removeClass("inactive");
           showRouteTable(data["markers"]);
           console.log(data["route_str"]);
-          console.log(data["optimal_duration"]);
           $("#routeOverview").html("<b>Route overview:</b> " + data["route_str"]);
-          $("#routeDuration").html("<b>Optimized route duration:</b> " + data["optimal_duration"] + " minutes");
+          if (data["route_polylines"] !== null) {
+              showRouteGeometry(data);
+          } else {
+              $("#routeDuration").html("<b>Optimized route duration:</b> calculating...");
+              $.getJSON("api/v1/routes/" + data["route_id"] + "/geometry",
+                        city ? {city: city} : {})
+                .done(showRouteGeometry)
+                .fail(function( jqXHR, textStatus, errorThrown ){
+                    console.log("route geometry failed:");
+                    console.log(textStatus);
+                    $("#routeDuration").html("<b>Optimized route duration:</b> unavailable");
+                });
+          }
       })
       .fail(function( jqXHR, textStatus, errorThrown ){
              console.log("makepostcall failed:");
@@ -179,15 +240,23 @@ function listMarkersTable(markers) {
     $('#markersTable').append(newRows);
 }
 
-function showRouteMap(markers, route_polylines) {
+function showRouteMarkers(markers) {
     var i;
+    var latlngs = [];
     for (i = 0; i < markers.length; i++) {
         var currentMarker = markers[i];
         var marker = L.marker([currentMarker.lat, currentMarker.lon]).addTo(map)
             .bindPopup(currentMarker.title);
+        latlngs.push([currentMarker.lat, currentMarker.lon]);
     }
-    var polyline = L.polyline(route_polylines, {color: 'red'}).addTo(map);
+    map.fitBounds(L.latLngBounds(latlngs));
+}
+
+function showRouteGeometry(data) {
+    console.log(data["optimal_duration"]);
+    var polyline = L.polyline(data["route_polylines"], {color: 'red'}).addTo(map);
     map.fitBounds(polyline.getBounds());
+    $("#routeDuration").html("<b>Optimized route duration:</b> " + data["optimal_duration"] + " minutes");
 }
 
 function showRouteTable(markers) {
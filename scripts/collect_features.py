@@ -33,6 +33,9 @@ FEAT_FULL_CSV_OUT = '../data/190130-df-feature-counts-full.csv'
 FEAT_CSV_OUT = '../data/190130-df-feature-counts.csv'
 MARKER_CSV_OUT = "../data/190130-df-marker.csv"
 
+# HMDB city (cty) whose markers are processed
+CITY = 'washington_dc'
+
 def standardize_text(df, col_name):
     text_series = df[col_name].copy()
     # remove one or more alternating series of periods and whitespace
@@ -52,9 +55,10 @@ def standardize_text(df, col_name):
 
 
 def feature_pipeline(ner_csv_in=NER_CSV_IN, feat_csv_out=FEAT_CSV_OUT,
-        marker_csv_out=MARKER_CSV_OUT, feat_full_csv_out=FEAT_FULL_CSV_OUT):
-    # load relevant DataFrames
-    df_marker = pd.read_csv(MARKER_CSV_IN).query("cty=='washington_dc'")
+        marker_csv_out=MARKER_CSV_OUT, feat_full_csv_out=FEAT_FULL_CSV_OUT,
+        city=CITY):
+    # load relevant DataFrames, of city's markers
+    df_marker = pd.read_csv(MARKER_CSV_IN).query("cty==@city")
     df_marker['text_clean'] = standardize_text(df_marker, 'text')
 
     df_wiki = pd.read_csv(WIKI_CSV_IN)
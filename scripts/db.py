@@ -2,26 +2,42 @@
 
 '''db.py : interact with postresql database
 
-Main task: take INPUT_CSV of marker data, INPUT_SIM of similarity matrix, and
-INPUT_ENT_1 and INPUT_ENT_2 of named entity counts per marker, and write them
-as the appropriate tables in cfg.postgres['DB_NAME'].
+Main task: take INPUT_CSV of marker data, INPUT_SIM of similarity neighbors, and
+INPUT_ENT of features (named entities, decades, wiki categories) per marker,
+and write them as the appropriate tables in cfg.postgres['DB_NAME'].
+
+Tables are partitioned on the city (cty) of their markers: loading a city
+replaces only its partitions, e.g. hmdb_data_table_washington_dc, and the app
+filters on cty so it only ever reads one city's partitions.
 '''
 
+import ast
+from datetime import datetime
+import re
+
 import config as cfg
 import numpy as np
 from sqlalchemy import create_engine
 from sqlalchemy_utils import database_exists, create_database
 import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.types import Text
 
 INPUT_CSV = '../data/190130-df-marker.csv'
-INPUT_SIM = "../data/190130-df-sim-tfidf.csv"
+INPUT_SIM = "../data/190130-df-sim-neighbors.csv"
 INPUT_ENT = "../data/190130-df-feature-counts.csv"
 INPUT_CLUST = '../data/190131-km-labels.csv'
 OUTPUT_TABLE = 'hmdb_data_table'
-OUTPUT_SIM_TABLE = 'similarities_data_table'
-OUTPUT_ENT_TABLE_1 = 'entities_data_table_1'
-OUTPUT_ENT_TABLE_2 = 'entities_data_table_2'
+OUTPUT_SIM_TABLE = 'similarity_neighbors_table'
+OUTPUT_ENT_TABLE = 'marker_entities_table'
 OUTPUT_CLUST_TABLE = 'clust_table'
+OUTPUT_VERSION_TABLE = 'data_version_table'
+# HMDB city (cty) of the markers in the input files
+CITY = 'washington_dc'
+
+# feature column suffixes added in collect_features
+FEATURE_TYPES = {'ne': 'named_entity', 'dc': 'decade', 'wc': 'wiki_category'}
 
 def create_connection(db_loc='dev'):
     if db_loc=='dev':
@@ -42,69 +58,147 @@ def create_connection(db_loc='dev'):
     print("create_connection: database engine url {}".format(engine.url))
     return engine
 
-def add_df_sim(input_csv, output_table, engine):
-    # add similarity matrix
-    # downcasted to float32 to pack in (otherwise row too wide)
-    df_sim = pd.read_csv(input_csv, index_col=0).astype(np.float32)
-    print('adding similarity matrix as {}'.format(output_table))
-    df_sim.to_sql(output_table, engine, if_exists='replace')
+def create_index(engine, table, columns):
+    # an index of a partitioned table is also built on each of its partitions,
+    # including those created by later loads
+    index_name = "ix_{}_{}".format(table, "_".join(columns)).replace(" ", "_")
+    query = "CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(index_name,
+            table, ", ".join(columns))
+    with engine.begin() as con:
+        con.execute(text(query))
+    return None
+
+def partition_name(table, city):
+    return "{}_{}".format(table, re.sub(r"\W", "_", city.lower()))
+
+def replace_partition(df, table, city, engine, dtype=None):
+    # write df as city's partition of table, partitioned on cty, leaving the
+    # partitions of other cities alone. df is written to a staging table
+    # first and swapped in by one transaction, so readers see either all of
+    # the old rows or all of the new ones
+    partition = partition_name(table, city)
+    staging = partition + "_load"
+    df = df.assign(cty=city)
+    df.to_sql(staging, engine, if_exists='replace', index=False, dtype=dtype)
+    columns = ", ".join('"{}"'.format(x) for x in df.columns)
+    with engine.begin() as con:
+        kind = con.execute(text("SELECT relkind FROM pg_class "
+                "WHERE oid = to_regclass(:table)"), {'table': table}).scalar()
+        if kind is not None and kind != 'p':
+            # tables loaded before partitioning held a single city
+            con.execute(text("DROP TABLE {}".format(table)))
+        con.execute(text("CREATE TABLE IF NOT EXISTS {} (LIKE {}) "
+                "PARTITION BY LIST (cty)".format(table, staging)))
+        con.execute(text("DROP TABLE IF EXISTS {}".format(partition)))
+        con.execute(text("CREATE TABLE {} PARTITION OF {} FOR VALUES IN ('{}')".format(
+                partition, table, city.replace("'", "''"))))
+        con.execute(text("INSERT INTO {} ({}) SELECT {} FROM {}".format(
+                partition, columns, columns, staging)))
+        con.execute(text("DROP TABLE {}".format(staging)))
+    return None
+
+def add_df_sim(input_csv, output_table, engine, city=CITY):
+    # add similarity neighbors in long format (marker_id, neighbor_id, score),
+    # so table width no longer grows with the number of markers
+    df_sim = pd.read_csv(input_csv).astype({'marker_id': np.int64,
+        'neighbor_id': np.int64, 'score': np.float32})
+    print('adding {} similarity neighbors to {}'.format(city, output_table))
+    replace_partition(df_sim, output_table, city, engine)
+    # one marker's neighbors, best first, is a single index range scan
+    create_index(engine, output_table, ['marker_id', 'score DESC'])
     return None
 
-def add_df_hmdb_data(input_csv, output_table, engine, cluster_csv):
+def parse_list_column(series):
+    # list columns were written to csv as python literals
+    return series.apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else [])
+
+def make_img_src(marker_id, images):
+    # path of first image's thumbnail, as served by nginx
+    if not images:
+        return None
+    img_id = images[0].split("/")[-1][5:-5].zfill(6)
+    return "static/img/{}_{}_small.jpg".format(str(marker_id).zfill(6), img_id)
+
+def add_df_hmdb_data(input_csv, output_table, engine, cluster_csv, city=CITY):
     # add HMDB data array. already filtered down to what is useful
     df = pd.read_csv(input_csv)
     # ugly hack to add cluster_csv column here...
     df_cluster = pd.read_csv(cluster_csv)
     df_total = pd.merge(df, df_cluster, on="marker_id", how="left")
-    print('adding hmdb data as {}'.format(output_table))
-    df_total.to_sql(output_table, engine, if_exists='replace', index=False)
-    return None
-
-def add_df_ent_two_parts(input_csv, output_table_1, output_table_2, engine):
-    df = pd.read_csv(input_csv, index_col='marker_id')
-    # split input into two parts because too many columns...
-    num_cols = len(df.columns)
-    halfway_col = num_cols//2
 
-    df_ent_1 = df.iloc[:,:halfway_col]
-    df_ent_2 = df.iloc[:,halfway_col:]
+    # materialize display fields so the app never parses them per request
+    df_total['images'] = parse_list_column(df_total['images'])
+    df_total['categories'] = parse_list_column(df_total['categories'])
+    df_total['img_src'] = [make_img_src(x, y) for (x, y)
+                           in zip(df_total.marker_id, df_total.images)]
 
-    print('adding first half of entity data as {}'.format(output_table_1))
-    df_ent_1.to_sql(OUTPUT_ENT_TABLE_1, engine, if_exists='replace',
-            index=True)
-
-    print('adding second half of entity data as {}'.format(output_table_2))
-    df_ent_2.to_sql(OUTPUT_ENT_TABLE_2, engine, if_exists='replace',
-            index=True)
+    print('adding {} hmdb data to {}'.format(city, output_table))
+    replace_partition(df_total, output_table, city, engine,
+            dtype={'images': ARRAY(Text), 'categories': ARRAY(Text)})
+    create_index(engine, output_table, ['marker_id'])
+    # nearest marker queries filter on a bounding box
+    create_index(engine, output_table, ['lat', 'lon'])
+    return None
 
+def add_df_ent(input_csv, output_table, engine, city=CITY):
+    # add features in long format (marker_id, feature, feature_type,
+    # display_name), one row per feature present on a marker, instead of a
+    # wide boolean matrix split across tables because of column limits
+    df = pd.read_csv(input_csv, index_col='marker_id').astype(bool)
+    rows, cols = np.nonzero(df.values)
+    features = df.columns.values[cols]
+    df_ent = pd.DataFrame({
+        'marker_id': df.index.values[rows],
+        'feature': features,
+        'feature_type': [FEATURE_TYPES.get(x.rsplit("_", 1)[-1]) for x in features],
+        'display_name': [x.split("_")[0].capitalize() for x in features],
+        })
+    print('adding {} entity data to {}'.format(city, output_table))
+    replace_partition(df_ent, output_table, city, engine)
+    create_index(engine, output_table, ['marker_id'])
     return None
 
-def add_df_clust(input_csv, output_table, engine):
+def add_df_clust(input_csv, output_table, engine, city=CITY):
     # add clusters
     df_clust = pd.read_csv(input_csv, index_col=0)
-    print('adding cluster df as {}'.format(output_table))
-    df_clust.to_sql(output_table, engine, if_exists='replace')
+    print('adding {} cluster df to {}'.format(city, output_table))
+    replace_partition(df_clust.reset_index(), output_table, city, engine)
+    return None
+
+def add_data_version(output_table, engine, city=CITY):
+    # record a new data version of city. written after all other tables,
+    # since the app swaps in a fresh copy of a city's data when its latest
+    # version changes
+    loaded_at = datetime.utcnow()
+    version = loaded_at.strftime("%Y%m%dT%H%M%S")
+    df_version = pd.DataFrame({'version': [version], 'loaded_at': [loaded_at],
+                               'cty': [city]})
+    # versions recorded before there were several cities have no cty
+    with engine.begin() as con:
+        con.execute(text("ALTER TABLE IF EXISTS {} "
+                "ADD COLUMN IF NOT EXISTS cty text".format(output_table)))
+    print('adding {} data version {} to {}'.format(city, version, output_table))
+    df_version.to_sql(output_table, engine, if_exists='append', index=False)
     return None
 
 def add_to_sql_pipeline(db_loc='dev',input_sim=INPUT_SIM,
         output_sim_table=OUTPUT_SIM_TABLE, input_csv=INPUT_CSV,
         output_table=OUTPUT_TABLE, input_ent=INPUT_ENT,
-        output_ent_table_1=OUTPUT_ENT_TABLE_1,
-        output_ent_table_2=OUTPUT_ENT_TABLE_2, input_clust=INPUT_CLUST,
-        output_clust_table=OUTPUT_CLUST_TABLE):
+        output_ent_table=OUTPUT_ENT_TABLE, input_clust=INPUT_CLUST,
+        output_clust_table=OUTPUT_CLUST_TABLE,
+        output_version_table=OUTPUT_VERSION_TABLE, city=CITY):
     engine = create_connection(db_loc)
-    add_df_sim(input_sim, output_sim_table, engine)
-    add_df_hmdb_data(input_csv, output_table, engine, input_clust)
-    add_df_ent_two_parts(input_ent, output_ent_table_1, output_ent_table_2,
-            engine)
-    add_df_clust(input_clust, output_clust_table, engine)
+    add_df_sim(input_sim, output_sim_table, engine, city)
+    add_df_hmdb_data(input_csv, output_table, engine, input_clust, city)
+    add_df_ent(input_ent, output_ent_table, engine, city)
+    add_df_clust(input_clust, output_clust_table, engine, city)
+    add_data_version(output_version_table, engine, city)
     return None
 
 if __name__ == '__main__':
     print('running db.py from command line')
     add_to_sql_pipeline('dev',INPUT_SIM, OUTPUT_SIM_TABLE,
                         INPUT_CSV, OUTPUT_TABLE,
-                        INPUT_ENT, OUTPUT_ENT_TABLE_1,
-                        OUTPUT_ENT_TABLE_2,
+                        INPUT_ENT, OUTPUT_ENT_TABLE,
                         INPUT_CLUST, OUTPUT_CLUST_TABLE)
     print('db.py: done.')
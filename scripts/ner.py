@@ -14,6 +14,8 @@ from sys import argv
 
 # processed CSV with marker text and hmdb category labels
 MARKER_CSV = '../data/190121-all-markers-with-cats.csv'
+# HMDB city (cty) whose markers are processed
+CITY = 'washington_dc'
 
 # various processing strings called in functions below, put here for convenience
 # regex to perform replacements on raw marker text, in this order
@@ -219,10 +221,10 @@ def drop_labels_regex(df_ent):
     df_ent = df_ent.loc[~df_ent.text.str.contains(labels_drop_regex)]
     return df_ent
 
-def ne_pipeline(csv_out=None, marker_csv=MARKER_CSV):
-    # combine steps from marker_csv to df_ent of entities
-    print("importing {}".format(marker_csv))
-    df = pd.read_csv(marker_csv).query('cty=="washington_dc"')
+def ne_pipeline(csv_out=None, marker_csv=MARKER_CSV, city=CITY):
+    # combine steps from marker_csv to df_ent of entities of city's markers
+    print("importing {} markers from {}".format(city, marker_csv))
+    df = pd.read_csv(marker_csv).query('cty==@city')
     
     print("cleaning marker text")
     df['text_clean'] = standardize_text(df, 'text')
@@ -7,6 +7,9 @@ for app deployment
 '''
 
 import argparse
+import os
+import subprocess
+import sys
 import ner
 import collect_features as cf
 import process_features as pf
@@ -16,6 +19,10 @@ import db
 N_COMPONENTS = 100
 N_CLUSTERS = 10
 
+# HMDB cities (cty) processed by default. each city's files are written to a
+# directory of its own (see city_path) and loaded as its own table partitions
+CITIES = ['washington_dc']
+
 # database (dev or production)
 DB_LOC = 'dev'
 # DB_LOC = 'production'
@@ -24,7 +31,7 @@ DB_LOC = 'dev'
 # processed CSV with marker text and hmdb category labels
 MARKER_CSV_IN = '../data/190206-all-markers-with-cats-credits.csv'
 
-## files created/passed along in pipeline
+## files created/passed along in pipeline, per city
 # recognized entities
 NER_CSV = '../data/190206-ner.csv'
 # counts of all features, per marker
@@ -33,49 +40,87 @@ FEAT_CSV = '../data/190206-feat-count.csv'
 MARKER_CSV_OUT = "../data/190206-marker-out.csv"
 # like FEAT_CSV, but without filtering for number of markers or features
 FEAT_FULL_CSV = '../data/190206-feat-full-count.csv'
-# similarity matrix, with index_col = marker_id and columns=marker_id
+# similarity matrix, with index_col = marker_id and columns=marker_id. only
+# written with --sim-matrix (for validation.py), as it grows with N x N
 SIM_CSV = '../data/190206-sim-tfidf.csv'
+# long format (marker_id, neighbor_id, score) of top similarity neighbors
+SIM_NEIGHBORS_CSV = '../data/190206-sim-neighbors.csv'
 # labels for markers in MARKER_CSV_OUT
 CLUST_CSV = '../data/190206-km-labels.csv'
 CLUST_TOP_TERMS_CSV = '../data/190206-km-top-terms.csv'
 
 ## SQL DB table names
 OUTPUT_TABLE = 'hmdb_data_table'
-OUTPUT_SIM_TABLE = 'similarities_data_table'
-OUTPUT_ENT_TABLE_1 = 'entities_data_table_1'
-OUTPUT_ENT_TABLE_2 = 'entities_data_table_2'
+OUTPUT_SIM_TABLE = 'similarity_neighbors_table'
+OUTPUT_ENT_TABLE = 'marker_entities_table'
 OUTPUT_CLUST_TABLE = 'clust_table'
 
+# backend app, whose app.precompute stores routes for the loaded data
+BACKEND_DIR = '../backend'
+# read-only dataset snapshots memory mapped by the app (its SNAPSHOT_DIR),
+# relative to BACKEND_DIR
+SNAPSHOT_DIR = '../data/snapshots'
+
 # other pipeline file dependencies hard coded into individual steps:
 # - decades
 # - wiki text
 
-def run_pipeline(ner_step=True, cf_step=True, pf_step=True, db_step=True):
+def city_path(path, city):
+    # path of a pipeline file in city's directory, e.g. ../data/washington_dc/
+    directory, name = os.path.split(path)
+    os.makedirs(os.path.join(directory, city), exist_ok=True)
+    return os.path.join(directory, city, name)
+
+def run_city_pipeline(city, ner_step=True, cf_step=True, pf_step=True,
+        db_step=True, snapshot_step=True, routes_step=True, sim_matrix=False):
     if ner_step:
-        print("pipeline.py: running ner")
-        ner.ne_pipeline(NER_CSV, MARKER_CSV_IN)
+        print("pipeline.py: running ner for {}".format(city))
+        ner.ne_pipeline(city_path(NER_CSV, city), MARKER_CSV_IN, city)
 
     if cf_step:
-        print("pipeline.py: running collect_features")
-        cf.feature_pipeline(NER_CSV, FEAT_CSV, MARKER_CSV_OUT, FEAT_FULL_CSV)
+        print("pipeline.py: running collect_features for {}".format(city))
+        cf.feature_pipeline(city_path(NER_CSV, city), city_path(FEAT_CSV, city),
+                city_path(MARKER_CSV_OUT, city), city_path(FEAT_FULL_CSV, city),
+                city)
 
     if pf_step:
-        print("pipeline.py: running process_features.calc_sim_matrix()")
-        pf.calc_sim_matrix(FEAT_CSV, SIM_CSV)
+        print("pipeline.py: running process_features.calc_sim_matrix() for {}".format(city))
+        sim_csv = city_path(SIM_CSV, city) if sim_matrix else None
+        pf.calc_sim_matrix(city_path(FEAT_CSV, city), sim_csv,
+                city_path(SIM_NEIGHBORS_CSV, city))
 
-        print("pipeline.py: running process_features.calc_clusters()")
-        pf.calc_clusters(FEAT_CSV, CLUST_CSV, CLUST_TOP_TERMS_CSV,
-                N_COMPONENTS, N_CLUSTERS)
+        print("pipeline.py: running process_features.calc_clusters() for {}".format(city))
+        pf.calc_clusters(city_path(FEAT_CSV, city), city_path(CLUST_CSV, city),
+                city_path(CLUST_TOP_TERMS_CSV, city), N_COMPONENTS, N_CLUSTERS)
 
     if db_step:
-        # split features into two parts
-        print("pipeline.py: running db.add_to_sql_pipeline()")
-        db.add_to_sql_pipeline(DB_LOC, SIM_CSV, OUTPUT_SIM_TABLE,
-                        MARKER_CSV_OUT, OUTPUT_TABLE,
-                        FEAT_CSV, OUTPUT_ENT_TABLE_1,
-                        OUTPUT_ENT_TABLE_2,
-                        CLUST_CSV, OUTPUT_CLUST_TABLE)
+        print("pipeline.py: running db.add_to_sql_pipeline() for {}".format(city))
+        db.add_to_sql_pipeline(DB_LOC, city_path(SIM_NEIGHBORS_CSV, city),
+                        OUTPUT_SIM_TABLE,
+                        city_path(MARKER_CSV_OUT, city), OUTPUT_TABLE,
+                        city_path(FEAT_CSV, city), OUTPUT_ENT_TABLE,
+                        city_path(CLUST_CSV, city), OUTPUT_CLUST_TABLE,
+                        city=city)
+
+    if snapshot_step:
+        print("pipeline.py: running app.snapshot for {}".format(city))
+        subprocess.run([sys.executable, '-m', 'app.snapshot', '--out',
+                SNAPSHOT_DIR, '--city', city], cwd=BACKEND_DIR, check=True)
+
+    if routes_step:
+        # uses the backend's settings (PASTPATH_DB_HOST etc.) to find the db
+        print("pipeline.py: running app.precompute for {}".format(city))
+        subprocess.run([sys.executable, '-m', 'app.precompute', '--city', city],
+                cwd=BACKEND_DIR, check=True)
+
+    return None
 
+def run_pipeline(ner_step=True, cf_step=True, pf_step=True, db_step=True,
+        snapshot_step=True, routes_step=True, cities=CITIES, sim_matrix=False):
+    # cities are processed one after another; each only replaces its own data
+    for city in cities:
+        run_city_pipeline(city, ner_step, cf_step, pf_step, db_step,
+                snapshot_step, routes_step, sim_matrix)
     return None
 
 if __name__ == '__main__':
@@ -86,5 +131,14 @@ if __name__ == '__main__':
     parser.add_argument('--cf', action='store_true')
     parser.add_argument('--pf', action='store_true')
     parser.add_argument('--db', action='store_true')
+    parser.add_argument('--snapshot', action='store_true')
+    parser.add_argument('--routes', action='store_true')
+    parser.add_argument('--sim-matrix', action='store_true',
+            help='with --pf, also write the full similarity matrix SIM_CSV '
+                 'read by validation.py')
+    parser.add_argument('--city', action='append',
+            help='HMDB city (cty) to process, may be repeated, default {}'.format(
+                ", ".join(CITIES)))
     args = parser.parse_args()
-    run_pipeline(args.ner, args.cf, args.pf, args.db)
+    run_pipeline(args.ner, args.cf, args.pf, args.db, args.snapshot,
+            args.routes, args.city or CITIES, args.sim_matrix)
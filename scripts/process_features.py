@@ -7,6 +7,7 @@ adapted from nb/190130-combine-cats-ents-decade-features.ipynb
 
 '''
 
+import numpy as np
 import pandas as pd
 from scipy import sparse
 from sklearn.feature_extraction.text import TfidfTransformer
@@ -25,14 +26,23 @@ from sys import argv
 N_COMPONENTS = 100
 N_CLUSTERS = 10
 
+# similarity neighbor parameters: keep at most SIM_TOP_K neighbors per marker
+# with score above SIM_MIN_SCORE, computing SIM_BLOCK_SIZE rows at a time
+SIM_TOP_K = 200
+SIM_MIN_SCORE = 0
+SIM_BLOCK_SIZE = 1000
+
 # file paths
 FEAT_CSV_IN = '../data/190130-df-feature-counts.csv'
 
 SIM_CSV_OUT = "../data/190130-df-sim-tfidf.csv"
+NEIGHBORS_CSV_OUT = "../data/190130-df-sim-neighbors.csv"
 CLUST_CSV_OUT = "../data/190130-km-labels.csv"
 CLUST_TOP_TERMS_OUT = "../data/190130-km-top-terms.csv"
 
-def calc_sim_matrix(feat_csv_in=FEAT_CSV_IN, sim_csv_out=SIM_CSV_OUT):
+def calc_sim_matrix(feat_csv_in=FEAT_CSV_IN, sim_csv_out=None,
+        neighbors_csv_out=NEIGHBORS_CSV_OUT, top_k=SIM_TOP_K,
+        min_score=SIM_MIN_SCORE):
     df_all_counts = pd.read_csv(feat_csv_in, index_col='marker_id')
     # print(df_all_counts.head())
 
@@ -41,14 +51,46 @@ def calc_sim_matrix(feat_csv_in=FEAT_CSV_IN, sim_csv_out=SIM_CSV_OUT):
     A_sparse = sparse.csr_matrix(df_all_counts)
     tfidf = TfidfTransformer()
     X = tfidf.fit_transform(A_sparse)
-    similarities = cosine_similarity(X)
 
     # ### Make similarities dataframe and save to file
-    df_sim_tfidf = pd.DataFrame(similarities, index=df_all_counts.index)
-    df_sim_tfidf.columns = df_all_counts.index
-    df_sim_tfidf.to_csv(sim_csv_out)
+    # full N x N matrix (e.g. SIM_CSV_OUT, read by validation.py) is only
+    # written when asked for, since it does not scale past a single city
+    if sim_csv_out is not None:
+        similarities = cosine_similarity(X)
+        df_sim_tfidf = pd.DataFrame(similarities, index=df_all_counts.index)
+        df_sim_tfidf.columns = df_all_counts.index
+        df_sim_tfidf.to_csv(sim_csv_out)
+
+    # ### Save long-format top neighbors, which is what gets loaded to the db
+    if neighbors_csv_out is not None:
+        df_neighbors = calc_sim_neighbors(X, df_all_counts.index.values,
+                top_k, min_score)
+        print("calc_sim_matrix(): saving {} neighbor pairs to {}".format(
+            len(df_neighbors), neighbors_csv_out))
+        df_neighbors.to_csv(neighbors_csv_out, index=False)
     return None
 
+def calc_sim_neighbors(X, marker_ids, top_k=SIM_TOP_K, min_score=SIM_MIN_SCORE,
+        block_size=SIM_BLOCK_SIZE):
+    # long format (marker_id, neighbor_id, score) of the top_k most similar
+    # markers per marker. similarities are calculated a block of rows at a
+    # time so the full matrix is never held in memory.
+    marker_ids = np.asarray(marker_ids)
+    top_k = min(top_k, len(marker_ids))
+    blocks = []
+    for start in range(0, X.shape[0], block_size):
+        sim = cosine_similarity(X[start:start+block_size], X)
+        top_idx = np.argpartition(-sim, top_k-1, axis=1)[:, :top_k]
+        top_scores = np.take_along_axis(sim, top_idx, axis=1)
+        blocks.append(pd.DataFrame({
+            'marker_id': np.repeat(marker_ids[start:start+len(sim)], top_k),
+            'neighbor_id': marker_ids[top_idx.ravel()],
+            'score': top_scores.ravel()}))
+    df_neighbors = pd.concat(blocks, ignore_index=True)
+    df_neighbors = df_neighbors[df_neighbors.score > min_score]
+    return df_neighbors.sort_values(['marker_id', 'score'],
+            ascending=[True, False])
+
 def calc_clusters(feat_csv_in=FEAT_CSV_IN, clust_csv_out=CLUST_CSV_OUT,
         clust_top_terms_out=CLUST_TOP_TERMS_OUT, n_components=N_COMPONENTS, n_clusters=N_CLUSTERS):
     # #### Perform SVD followed by k-means on TF-IDF weighted output.
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
 '''validation.py : check whether similarity predictions are reasonable.
+
+Reads the full similarity matrix SIM_CSV, which the pipeline only writes when
+run with --pf --sim-matrix.
 '''
 
 import numpy as np
@@ -11,6 +14,8 @@ from sys import argv
 MARKER_CSV = '../data/190130-df-marker.csv'
 FEAT_CSV = "../data/190130-df-feature-counts.csv"
 SIM_CSV = "../data/190130-df-sim-tfidf.csv"
+# HMDB city (cty) of the markers in SIM_CSV
+CITY = 'washington_dc'
 
 def top_similar_marker_id(marker_id, sim_csv, n=10):
     df_sim = pd.read_csv(sim_csv, index_col='marker_id')
@@ -23,18 +28,18 @@ def top_similar_marker_id(marker_id, sim_csv, n=10):
     top_n_id = df_sim.iloc[:,top_n_idx].columns.values.astype(int)
     return top_n_id, top_n_sims
 
-def top_similarities_random(marker_csv, sim_csv, n=10):
-    df = pd.read_csv(marker_csv).query("cty=='washington_dc'")
+def top_similarities_random(marker_csv, sim_csv, n=10, city=CITY):
+    df = pd.read_csv(marker_csv).query("cty==@city")
     random_id = random.choice(df.marker_id.unique())
     return top_similar_marker_id(random_id, sim_csv, n)
 
-def marker_title_from_id(marker_id, marker_csv):
-    df = pd.read_csv(marker_csv).query("cty=='washington_dc'")
+def marker_title_from_id(marker_id, marker_csv, city=CITY):
+    df = pd.read_csv(marker_csv).query("cty==@city")
     marker = df[df.marker_id==marker_id]
     return marker.title.values[0]
 
-def marker_text_from_id(marker_id, marker_csv):
-    df = pd.read_csv(marker_csv).query("cty=='washington_dc'")
+def marker_text_from_id(marker_id, marker_csv, city=CITY):
+    df = pd.read_csv(marker_csv).query("cty==@city")
     marker = df[df.marker_id==marker_id]
     return marker.text_clean.values[0]
 
@@ -84,6 +89,7 @@ if __name__ == '__main__':
     print('MARKER_CSV = {}'.format(MARKER_CSV))
     print('FEAT_CSV = {}'.format(FEAT_CSV))
     print('SIM_CSV = {}'.format(SIM_CSV))
+    print('CITY = {}'.format(CITY))
 
     print("======")
     print("RANDOM MARKER")